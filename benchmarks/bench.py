@@ -0,0 +1,441 @@
+"""Benchmarks for PyPackProxy.
+
+Starts a fake upstream index in this process and ``pypackproxy`` as a
+subprocess pointing at it, then drives the proxy with concurrent clients
+and prints the results as JSON::
+
+    python benchmarks/bench.py -c 16 -n 400 -o results.json
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from html import escape, unescape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+SCENARIOS = ('cold-simple', 'warm-simple', 'local-simple', 'miss-download',
+             'hit-download', 'same-file-download', 'parallel-download')
+JSON_TYPE = 'application/vnd.pypi.simple.v1+json'
+_href_re = re.compile(r'href="([^"]+)"')
+_requests_total_re = re.compile(
+    r'^pypackproxy_requests_total\{route="([^"]+)",[^}]*\} (\d+)$', re.M)
+_range_re = re.compile(r'^bytes=(\d+)-(\d*)$')
+# files of 'parallel-*' projects are this many times larger and are
+# downloaded with several range requests
+_PARALLEL_FACTOR = 8
+_PARALLEL_PARTS = 4
+_TRICKLE_SIZE = 16 * 1024
+
+
+class FakeIndex(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, files, file_size, latency, failure_rate, page_format,
+                 seed):
+        super().__init__(('127.0.0.1', 0), _FakeIndexHandler)
+        self.files = files
+        self.file_size = file_size
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.page_format = page_format
+        self.content = (bytes(range(256)) * (file_size // 256 + 1))[
+            :file_size]
+        self.sha256 = hashlib.sha256(self.content).hexdigest()
+        # no period of 256 bytes, so misplaced blocks change the hash, and
+        # an odd size, so the parts do not end on buffer boundaries
+        large_size = file_size * _PARALLEL_FACTOR + 1001
+        self.large_content = b''.join(
+            hashlib.sha256(str(i).encode()).digest()
+            for i in range(large_size // 32 + 1))[:large_size]
+        self.large_sha256 = hashlib.sha256(self.large_content).hexdigest()
+        self.counts = {'pages': 0, 'files': 0, 'failures': 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # the proxy closes range requests it no longer needs
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def count(self, kind):
+        with self._lock:
+            self.counts[kind] += 1
+            return self._random.random() < self.failure_rate
+
+    def file(self, project):
+        if project.startswith('parallel-'):
+            return self.large_content, self.large_sha256
+        return self.content, self.sha256
+
+    def page(self, project):
+        files = [f'{project}-{i}.0.tar.gz' for i in range(self.files)]
+        content, sha256 = self.file(project)
+        if self.page_format == 'json':
+            return JSON_TYPE, json.dumps({
+                'meta': {'api-version': '1.1'}, 'name': project,
+                'files': [{'filename': name,
+                           'url': f'/files/{project}/{name}',
+                           'hashes': {'sha256': sha256},
+                           'size': len(content)} for name in files],
+                'versions': [f'{i}.0' for i in range(self.files)]})
+        links = '\n'.join(f'<a href="/files/{project}/{name}#sha256='
+                          f'{sha256}">{escape(name)}</a><br>'
+                          for name in files)
+        return 'text/html', (f'<!DOCTYPE html><html><body>\n{links}\n'
+                             '</body></html>\n')
+
+
+class _FakeIndexHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        parts = self.path.strip('/').split('/')
+        kind = 'files' if parts[0] == 'files' else 'pages'
+        failed = server.count(kind)
+        time.sleep(server.latency)
+        if failed:
+            with server._lock:
+                server.counts['failures'] += 1
+            return self._send(503, 'text/plain', b'unavailable')
+        if kind == 'pages' and len(parts) == 2 and parts[0] == 'simple':
+            content_type, text = server.page(parts[1])
+            self._send(200, content_type, text.encode('utf-8'))
+        elif kind == 'files' and len(parts) == 3:
+            content = server.file(parts[1])[0]
+            trickle = content is server.large_content
+            match = _range_re.match(self.headers.get('Range', ''))
+            if match:
+                start = int(match.group(1))
+                end = min(int(match.group(2) or len(content) - 1),
+                          len(content) - 1)
+                self._send(206, 'application/octet-stream',
+                           content[start:end + 1],
+                           f'bytes {start}-{end}/{len(content)}', trickle)
+            else:
+                self._send(200, 'application/octet-stream', content,
+                           trickle=trickle)
+        else:
+            self._send(404, 'text/plain', b'not found')
+
+    def _send(self, status, content_type, body, content_range=None,
+              trickle=False):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if content_range:
+            self.send_header('Content-Range', content_range)
+        if content_type == 'application/octet-stream':
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if not trickle:
+            self.wfile.write(body)
+            return
+        # slow large files down, so clients stream them while the
+        # proxy is still fetching their parts
+        for start in range(0, len(body), _TRICKLE_SIZE):
+            self.wfile.write(body[start:start + _TRICKLE_SIZE])
+            self.wfile.flush()
+            time.sleep(self.server.latency / 10)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Proxy:
+    def __init__(self, index_url, work_dir, threads, workers, file_size):
+        self.port = _free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        storage = os.path.join(work_dir, 'storage')
+        cache = os.path.join(work_dir, 'cache')
+        os.makedirs(storage)
+        os.makedirs(cache)
+        self.storage = storage
+        self.config = os.path.join(work_dir, 'pypackproxy.ini')
+        with open(self.config, 'w') as fh:
+            fh.write(_CONFIG % dict(
+                index_url=index_url, storage=storage, cache=cache,
+                port=self.port, threads=threads, workers=workers,
+                parts=_PARALLEL_PARTS, parallel_min=file_size + 1))
+        self._process = None
+
+    def start(self):
+        self._process = subprocess.Popen(
+            [sys.executable, '-m', 'pypackproxy', self.config])
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise RuntimeError('pypackproxy exited with status'
+                                   f' {self._process.returncode}')
+            try:
+                requests.get(self.url + '/', timeout=1)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        raise RuntimeError('pypackproxy did not start')
+
+    def stop(self):
+        if self._process and self._process.poll() is None:
+            self._process.send_signal(signal.SIGTERM)
+            self._process.wait(30)
+
+    def memory(self):
+        return _rss_kb(self._process.pid)
+
+    def requests_by_route(self):
+        text = requests.get(self.url + '/metrics', timeout=10).text
+        rv = {}
+        for route, count in _requests_total_re.findall(text):
+            rv[route] = rv.get(route, 0) + int(count)
+        return rv
+
+
+def run(func, count, concurrency, sha256=None):
+    local = threading.local()
+    latencies = []
+    errors = 0
+    corrupt = 0
+    size = 0
+    lock = threading.Lock()
+
+    def call(i):
+        nonlocal errors, corrupt, size
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            response = func(session, i)
+            ok = response.status_code in (200, 304)
+            length = len(response.content)
+            damaged = (ok and sha256 is not None and
+                       hashlib.sha256(response.content).hexdigest() != sha256)
+        except requests.RequestException:
+            ok, length, damaged = False, 0, False
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            size += length
+            if not ok:
+                errors += 1
+            if damaged:
+                corrupt += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(call, range(count)))
+    duration = time.perf_counter() - start
+    latencies.sort()
+    return {'requests': count, 'errors': errors, 'corrupt': corrupt,
+            'bytes': size,
+            'seconds': round(duration, 4),
+            'throughput': round(count / duration, 2),
+            'p50_ms': round(_percentile(latencies, 50) * 1000, 3),
+            'p99_ms': round(_percentile(latencies, 99) * 1000, 3)}
+
+
+def scenarios(proxy, index, args):
+    simple = proxy.url + '/simple'
+
+    def links(session, project):
+        page = session.get(f'{simple}/{project}/').text
+        return [proxy.url + unescape(href).split('#')[0]
+                for href in _href_re.findall(page)]
+
+    yield ('cold-simple', lambda s, i: s.get(f'{simple}/cold-{i}/'), None,
+           None)
+    yield ('warm-simple', lambda s, i: s.get(f'{simple}/warm/'),
+           lambda s: s.get(f'{simple}/warm/'), None)
+    yield ('local-simple', lambda s, i: s.get(f'{simple}/local-project/'),
+           None, None)
+    miss = []
+    yield ('miss-download', lambda s, i: s.get(miss[i]),
+           lambda s: miss.extend(
+               url for n in range(args.requests // args.files + 1)
+               for url in links(s, f'miss-{n}')), index.sha256)
+    hit = []
+    yield ('hit-download', lambda s, i: s.get(hit[0]),
+           lambda s: (hit.extend(links(s, 'hit')), s.get(hit[0])),
+           index.sha256)
+    same = []
+    yield ('same-file-download',
+           lambda s, i: s.get(same[i // args.concurrency]),
+           lambda s: same.extend(
+               url for n in range(args.requests // args.files + 1)
+               for url in links(s, f'same-{n}')), index.sha256)
+    # clients stream the file while its parts are still being fetched
+    parallel = []
+    yield ('parallel-download',
+           lambda s, i: s.get(parallel[i // args.concurrency]),
+           lambda s: parallel.extend(
+               url for n in range(args.requests // args.files + 1)
+               for url in links(s, f'parallel-{n}')), index.large_sha256)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--requests', type=int, default=200,
+                        help='requests per scenario (default: %(default)s)')
+    parser.add_argument('-c', '--concurrency', type=int, default=8,
+                        help='concurrent clients (default: %(default)s)')
+    parser.add_argument('--files', type=int, default=100,
+                        help='files per project page (default: %(default)s)')
+    parser.add_argument('--file-size', type=int, default=64 * 1024,
+                        help='size of each file in bytes'
+                             ' (default: %(default)s)')
+    parser.add_argument('--format', choices=('html', 'json'),
+                        default='html', help='upstream page format'
+                                             ' (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='upstream latency in seconds'
+                             ' (default: %(default)s)')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='fraction of failing upstream requests'
+                             ' (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=50,
+                        help='server thread pool (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='server worker processes'
+                             ' (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed (default: %(default)s)')
+    parser.add_argument('-s', '--scenario', action='append',
+                        choices=SCENARIOS, help='run only this scenario'
+                                                ' (repeatable)')
+    parser.add_argument('-o', '--output', help='write JSON results to file')
+    args = parser.parse_args()
+    index = FakeIndex(args.files, args.file_size, args.latency,
+                      args.failure_rate, args.format, args.seed)
+    threading.Thread(target=index.serve_forever, daemon=True).start()
+    results = {'python': platform.python_version(),
+               'pypackproxy': _version(),
+               'params': {k: v for k, v in vars(args).items()
+                          if k != 'output'},
+               'scenarios': {}}
+    with tempfile.TemporaryDirectory() as work_dir:
+        proxy = Proxy(index.url + '/simple', work_dir, args.threads,
+                      args.workers, args.file_size)
+        # local projects are indexed when the proxy starts
+        project_path = os.path.join(proxy.storage, 'local-project')
+        os.makedirs(project_path)
+        for i in range(args.files):
+            with open(os.path.join(project_path,
+                                   f'local_project-{i}.0.tar.gz'),
+                      'wb') as fh:
+                fh.write(index.content[:1024])
+        proxy.start()
+        try:
+            for name, func, prepare, sha256 in scenarios(proxy, index,
+                                                         args):
+                if args.scenario and name not in args.scenario:
+                    continue
+                if prepare:
+                    with requests.Session() as session:
+                        prepare(session)
+                counts = dict(index.counts)
+                routes = proxy.requests_by_route()
+                result = run(func, args.requests, args.concurrency,
+                             sha256)
+                result['upstream'] = {k: index.counts[k] - counts[k]
+                                      for k in counts}
+                result['routes'] = {
+                    route: count - routes.get(route, 0)
+                    for route, count in proxy.requests_by_route().items()
+                    if route != 'metrics' and count != routes.get(route, 0)}
+                # with several workers /metrics only shows one of them
+                route = 'simple' if name.endswith('-simple') else 'packs'
+                if (args.workers == 1 and
+                        result['routes'].get(route, 0) < args.requests):
+                    print(f'{name}: expected {args.requests} requests with'
+                          f' route="{route}" in /metrics, got'
+                          f' {result["routes"]}', file=sys.stderr)
+                if result['corrupt']:
+                    print(f'{name}: {result["corrupt"]} response(s) did not'
+                          ' match the sha256 of the file', file=sys.stderr)
+                result['rss_kb'] = proxy.memory()
+                results['scenarios'][name] = result
+                print(f'{name}: {result["throughput"]} req/s,'
+                      f' p50 {result["p50_ms"]} ms,'
+                      f' p99 {result["p99_ms"]} ms,'
+                      f' {result["errors"]} error(s)', file=sys.stderr)
+        finally:
+            proxy.stop()
+            index.shutdown()
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(output + '\n')
+    else:
+        print(output)
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, len(values) * percent // 100)]
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _version():
+    try:
+        from pypackproxy import __version__
+        return __version__
+    except ImportError:
+        return None
+
+
+_CONFIG = '''[pypackproxy]
+index-url = %(index_url)s
+project-url = false
+storage-path = %(storage)s
+cache-path = %(cache)s
+admin-pass = false
+local-projects = local-*
+retries = 0
+download-parts = %(parts)s
+download-parallel-min = %(parallel_min)s
+
+[server]
+host = 127.0.0.1:%(port)s
+daemonize = no
+thread_pool = %(threads)s
+workers = %(workers)s
+'''
+
+
+if __name__ == '__main__':
+    main()
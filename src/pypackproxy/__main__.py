@@ -2,10 +2,13 @@ import mimetypes
 import sys
 
 import cherrypy
-from cherrypy._cpnative_server import CPHTTPServer
 
-from . import renderer, root, packs, simple, __version__, PYPP_DEBUG, PROG_NAME
+from . import (eviction, renderer, root, packs, simple, storage, upstream,
+               __version__, PYPP_DEBUG, PROG_NAME)
 from .configuration import configure
+from .scrub import scrub
+from .warm import warm
+from .workers import WorkerMonitor, WorkerServer
 
 mimetypes.add_type('application/octet-stream', '.whl')
 
@@ -15,10 +18,22 @@ def main(config: 'Configuration file'):  # noqa: F722
         cfg = configure(config)
         renderer.init()
         cherrypy.log('START', 'INFO')
-        cherrypy.server.httpserver = CPHTTPServer(cherrypy.server)
-        cherrypy.tree.mount(root.Root(cfg), root.path, root.config)
-        cherrypy.tree.mount(packs.Packs(cfg), packs.path, packs.config)
-        cherrypy.tree.mount(simple.Simple(cfg), simple.path, simple.config)
+        cherrypy.server.httpserver = WorkerServer(cherrypy.server)
+        index = storage.StorageIndex(cfg)
+        index.load()
+        if cfg['rescan-interval']:
+            WorkerMonitor(cherrypy.engine, index.rescan,
+                          cfg['rescan-interval'], 'StorageRescan').subscribe()
+        if cfg['storage-quota'] or cfg['evict-max-age']:
+            WorkerMonitor(cherrypy.engine, eviction.Evictor(cfg, index).run,
+                          cfg['evict-interval'], 'StorageEviction').subscribe()
+        client = upstream.Upstream(cfg)
+        cherrypy.engine.subscribe('stop', client.close)
+        cherrypy.tree.mount(root.Root(cfg, index), root.path, root.config)
+        cherrypy.tree.mount(packs.Packs(cfg, client, index), packs.path,
+                            packs.config)
+        cherrypy.tree.mount(simple.Simple(cfg, client, index), simple.path,
+                            simple.config)
         cherrypy.engine.signals.subscribe()
         cherrypy.engine.start()
         cherrypy.engine.block()
@@ -30,11 +45,15 @@ def main(config: 'Configuration file'):  # noqa: F722
 
 
 main.description = f'{PROG_NAME} {__version__}'
+_COMMANDS = {'scrub': scrub, 'warm': warm}
 
 
 def entry_point():
     import plac
-    plac.call(main)
+    if len(sys.argv) > 1 and sys.argv[1] in _COMMANDS:
+        plac.call(_COMMANDS[sys.argv[1]], sys.argv[2:])
+    else:
+        plac.call(main)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,46 @@
+import os
+
+import cherrypy
+
+blobs_dir = '.blobs'
+
+
+class BlobStore:
+    def __init__(self, storage_path):
+        self._path = os.path.join(storage_path, blobs_dir)
+
+    def path(self, sha256):
+        return os.path.join(self._path, sha256[:2], sha256[2:4], sha256)
+
+    def link(self, sha256, file_path):
+        tmp_path = os.path.join(os.path.dirname(file_path),
+                                f'.{os.path.basename(file_path)}.link')
+        try:
+            os.link(self.path(sha256), tmp_path)
+        except FileNotFoundError:
+            return False
+        except FileExistsError:
+            os.remove(tmp_path)
+            return self.link(sha256, file_path)
+        os.replace(tmp_path, file_path)
+        return True
+
+    def add(self, sha256, file_path):
+        blob_path = self.path(sha256)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        try:
+            os.link(file_path, blob_path)
+        except FileExistsError:
+            if not os.path.samefile(file_path, blob_path):
+                self.link(sha256, file_path)
+        except OSError as ex:
+            cherrypy.log(f'blob store: {ex}', 'WARNING')
+
+
+def release_blob(storage_path, sha256):
+    blob_path = BlobStore(storage_path).path(sha256)
+    try:
+        if os.stat(blob_path).st_nlink == 1:
+            os.remove(blob_path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+import cherrypy
+
+from .utils import temp_file, write_atomic
+
+CacheEntry = namedtuple('CacheEntry',
+                        'text content_type etag last_modified fresh')
+
+page_ext = '.page'
+meta_ext = '.json'
+
+
+class PageCache:
+    def __init__(self, path, ttl):
+        self._path = path
+        self._ttl = ttl
+        os.makedirs(self._path, exist_ok=True)
+
+    def get(self, key):
+        page_path, meta_path = self._paths(key)
+        try:
+            stat = os.stat(meta_path)
+            with open(meta_path, encoding='utf-8') as fh:
+                meta = json.load(fh)
+            with open(page_path, encoding='utf-8') as fh:
+                text = fh.read()
+        except (OSError, ValueError):
+            return None
+        return CacheEntry(text, meta.get('content-type'), meta.get('etag'),
+                          meta.get('last-modified'),
+                          time.time() - stat.st_mtime < self._ttl)
+
+    def put(self, key, text, content_type, etag=None, last_modified=None):
+        page_path, meta_path = self._paths(key)
+        try:
+            write_atomic(page_path, text)
+            write_atomic(meta_path, json.dumps(
+                {'content-type': content_type, 'etag': etag,
+                 'last-modified': last_modified}))
+        except OSError as ex:
+            cherrypy.log(f'page cache: {ex}', 'WARNING')
+
+    def writer(self, key):
+        return _PageWriter(self, key)
+
+    def touch(self, key):
+        try:
+            os.utime(self._paths(key)[1])
+        except OSError as ex:
+            cherrypy.log(f'page cache: {ex}', 'WARNING')
+
+    def _paths(self, key):
+        base = os.path.join(self._path, key)
+        return base + page_ext, base + meta_ext
+
+
+class _PageWriter:
+    def __init__(self, cache, key):
+        self._cache = cache
+        self._key = key
+        self._fh, self._tmp_path = temp_file(cache._path)
+
+    def write(self, text):
+        self._fh.write(text.encode('utf-8'))
+
+    def commit(self, content_type, etag=None, last_modified=None):
+        page_path, meta_path = self._cache._paths(self._key)
+        try:
+            self._fh.close()
+            os.replace(self._tmp_path, page_path)
+            write_atomic(meta_path, json.dumps(
+                {'content-type': content_type, 'etag': etag,
+                 'last-modified': last_modified}))
+        except OSError as ex:
+            cherrypy.log(f'page cache: {ex}', 'WARNING')
+            self.discard()
+
+    def discard(self):
+        self._fh.close()
+        try:
+            os.remove(self._tmp_path)
+        except OSError:
+            pass
+
+
+class RenderedPages:
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._pages = {}
+
+    def get(self, project, kind, files, render):
+        key = project, kind
+        page = self._pages.get(key)
+        if page and page[0] is files:
+            return page[1], page[2]
+        fingerprint = _fingerprint(files)
+        etag = f'"{fingerprint}-{kind}"'
+        project_path = os.path.join(self._path, project)
+        page_path = os.path.join(project_path, f'{fingerprint}.{kind}')
+        try:
+            with open(page_path, 'rb') as fh:
+                body = fh.read()
+        except OSError:
+            body = render()
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            try:
+                os.makedirs(project_path, exist_ok=True)
+                write_atomic(page_path, body)
+                _remove_others(project_path, kind, page_path)
+            except OSError as ex:
+                cherrypy.log(f'rendered pages: {ex}', 'WARNING')
+        with self._lock:
+            self._pages[key] = files, body, etag
+        return body, etag
+
+
+def _fingerprint(files):
+    data = hashlib.sha1()
+    for file in files:
+        data.update(f'{file.name}\0{file.size}\0{file.mtime}\0'
+                    f'{file.hashes.get("sha256")}\0{file.metadata}\n'
+                    .encode('utf-8'))
+    return data.hexdigest()
+
+
+def _remove_others(project_path, kind, page_path):
+    with os.scandir(project_path) as it:
+        for entry in it:
+            if entry.name.endswith('.' + kind) and entry.path != page_path:
+                os.remove(entry.path)
+
+
+def conditional_headers(entry):
+    headers = {}
+    if entry:
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+    return headers
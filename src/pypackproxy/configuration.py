@@ -1,3 +1,4 @@
+import logging
 import os
 from importlib.resources import open_text
 from logging.handlers import RotatingFileHandler
@@ -8,9 +9,10 @@ import salmagundi.config
 from cherrypy.process.plugins import Daemonizer, PIDFile, DropPrivileges
 from salmagundi.strings import split_host_port
 
-from . import __version__, PYPP_DEBUG, PROG_NAME, DATA_PACKAGE
+from . import __version__, tracing, PYPP_DEBUG, PROG_NAME, DATA_PACKAGE
 from .utils import (check_path, check_url, file_size, check_passwd,
-                    pos_float, pos_int)
+                    pos_float, pos_int, str_list)
+from .workers import Workers
 
 
 _CONFIG_SPEC = (DATA_PACKAGE, 'config_spec.ini')
@@ -18,15 +20,17 @@ _CONVERTERS = {'hostport': split_host_port,
                'filesize': file_size,
                'passwd': check_passwd,
                'posfloat': pos_float,
-               'posint': pos_int}
+               'posint': pos_int,
+               'strlist': str_list}
 
 
-def configure(cfgfile):
+def configure(cfgfile, serve=True):
     with open_text(*_CONFIG_SPEC) as fh:
         cfg = salmagundi.config.configure(cfgfile, fh, create_properties=False,
                                           converters=_CONVERTERS)
     _logging(cfg)
     _storage_path(cfg)
+    _cache_path(cfg)
     _index_url(cfg)
     _project_url(cfg)
     _ssl(cfg)
@@ -35,25 +39,46 @@ def configure(cfgfile):
         'response.headers.Server': f'{PROG_NAME}/{__version__}',
         'server.socket_host': host,
         'server.socket_port': port,
+        'server.thread_pool': max(cfg['server', 'thread_pool'], 1),
+        'server.socket_queue_size': cfg['server', 'socket_queue_size'],
+        'server.max_request_body_size': cfg['server',
+                                            'max_request_body_size'],
         'engine.autoreload.on': False,
         'request.show_tracebacks': PYPP_DEBUG,
         'request.show_mismatched_params': PYPP_DEBUG,
+        'tools.metrics.on': cfg['pypackproxy', 'metrics'],
+        'tools.tracing.on': True,
+        'tools.tracing.server_timing': cfg['pypackproxy', 'server-timing'],
+        'tools.tracing.slow': cfg['logging', 'slow-request'],
+        'tools.tracing.sample': cfg['logging', 'trace-sample'],
     })
     if PYPP_DEBUG:
         cherrypy.engine.signal_handler.handlers['SIGUSR2'] =\
             lambda: cherrypy.engine.restart()
-    if cfg['server', 'daemonize']:
+    if serve and cfg['server', 'daemonize']:
         Daemonizer(cherrypy.engine).subscribe()
         cherrypy.engine.signal_handler.handlers['SIGUSR1'] = None
     if os.getuid() == 0:
         uid, gid = _user_group(cfg)
         if uid:
-            DropPrivileges(cherrypy.engine, uid=uid, gid=gid).subscribe()
+            plugin = DropPrivileges(cherrypy.engine, uid=uid, gid=gid)
+            if serve:
+                plugin.subscribe()
+            else:
+                # the subcommands do not start the engine, but must not
+                # leave root-owned files in the storage
+                plugin.start()
         else:
             cherrypy.log("running as 'root'", 'WARNING')
-    if cfg['server', 'pidfile']:
-        PIDFile(cherrypy.engine, cfg['server', 'pidfile']).subscribe()
+    pidfile = None
+    if serve and cfg['server', 'pidfile']:
+        pidfile = PIDFile(cherrypy.engine, cfg['server', 'pidfile'])
+        pidfile.subscribe()
+    if serve and cfg['server', 'workers'] > 1:
+        Workers(cherrypy.engine, cfg['server', 'workers'],
+                pidfile).subscribe()
     rv = {opt: cfg['pypackproxy', opt] for opt in cfg.options('pypackproxy')}
+    rv['workers'] = cfg['server', 'workers']
     rv['proxies'] = _proxies(cfg)
     rv['user-agent'] = f'{PROG_NAME}/{__version__}'
     return rv
@@ -65,12 +90,30 @@ def _storage_path(cfg):
     cherrypy.config.update({'tools.staticdir.root': path})
 
 
+def _cache_path(cfg):
+    path = cfg['pypackproxy', 'cache-path']
+    if path:
+        check_path(path, 'cache-path')
+
+
 def _index_url(cfg):
-    index_url = cfg['pypackproxy', 'index-url']
-    if not index_url or index_url.lower() == 'false':
+    index_urls = cfg['pypackproxy', 'index-url']
+    if not index_urls or index_urls[0].lower() == 'false':
         cfg['pypackproxy', 'index-url'] = False
-        return
-    check_url(index_url, 'index-url')
+        index_urls = []
+    for index_url in index_urls:
+        check_url(index_url, 'index-url')
+    pins = []
+    for pin in cfg['pypackproxy', 'index-pins'] or ():
+        pattern, _, pos = pin.rpartition('=')
+        try:
+            pos = int(pos) - 1
+        except ValueError:
+            pos = -1
+        if not pattern or not 0 <= pos < len(index_urls):
+            raise ValueError(f'invalid index-pins entry: {pin}')
+        pins.append((pattern, pos))
+    cfg['pypackproxy', 'index-pins'] = pins
 
 
 def _project_url(cfg):
@@ -159,3 +202,11 @@ def _logging(cfg):
         handler.addFilter(
             lambda record: 0 if 'NATIVE_ADAPTER' in record.msg else 1)
         cherrypy.log.error_log.addHandler(handler)
+    trace_path = cfg['logging', 'trace-file']
+    if trace_path:
+        check_path(os.path.dirname(trace_path), 'trace-file path')
+        handler = RotatingFileHandler(trace_path, 'a',
+                                      cfg['logging', 'trace-size'],
+                                      cfg['logging', 'trace-count'])
+        tracing.trace_log.addHandler(handler)
+        tracing.trace_log.setLevel(logging.INFO)
@@ -0,0 +1,62 @@
+import os
+import time
+
+import cherrypy
+from salmagundi.strings import format_bin_prefix
+
+from .root import project_lock, remove_file
+
+_LOW_WATER = 0.9
+
+
+class Evictor:
+    def __init__(self, cfg, index):
+        self._storage = cfg['storage-path']
+        self._quota = cfg['storage-quota']
+        self._max_age = cfg['evict-max-age'] * 86400
+        self._index = index
+
+    def run(self):
+        entries = self._index.entries()
+        total = self._index.size()
+        # evict when the quota is exceeded, then down to the low-water mark,
+        # so that not every run has to evict again
+        if self._quota and total > self._quota:
+            target = self._quota * _LOW_WATER
+        else:
+            target = total
+        expires = time.time() - self._max_age if self._max_age else 0
+        if total <= target and not any(
+                file.atime < expires for _, file in entries):
+            return
+        candidates = sorted(((file.atime, project, file)
+                             for project, file in entries
+                             if not file.uploaded),
+                            key=lambda c: c[0])
+        count = freed = 0
+        for atime, project, file in candidates:
+            if total - freed <= target and atime >= expires:
+                break
+            limit = expires if total - freed <= target else atime
+            if self._evict(project, file, limit):
+                count += 1
+                freed += file.size
+        if count:
+            cherrypy.log(f'evicted {count} file(s),'
+                         f' {format_bin_prefix(".1f", freed)}', 'INFO')
+
+    def _evict(self, project, file, limit):
+        project_path = os.path.join(self._storage, project)
+        file_path = os.path.join(project_path, file.name)
+        try:
+            with project_lock(project_path):
+                # another worker may have served the file since the last scan
+                if os.stat(file_path).st_atime > limit:
+                    return False
+                remove_file(file_path)
+            return True
+        except OSError as ex:
+            cherrypy.log(f'evict {file_path}: {ex}', 'WARNING')
+            return False
+        finally:
+            self._index.update(project, file.name)
@@ -0,0 +1,132 @@
+import hashlib
+import os
+import threading
+import time
+
+import cherrypy
+import requests
+
+from . import metrics, pages
+from .cache import PageCache, conditional_headers
+
+_NOT_FOUND_MAX = 10000
+_CHUNK_SIZE = 65536
+
+
+class UpstreamIndex:
+    def __init__(self, cfg, client, url):
+        self.url = url if url.endswith('/') else url + '/'
+        self._client = client
+        if cfg['cache-path']:
+            name = hashlib.sha1(self.url.encode()).hexdigest()[:16]
+            self._cache = PageCache(
+                os.path.join(cfg['cache-path'], 'simple', name),
+                cfg['cache-ttl'])
+        else:
+            self._cache = None
+        self._negative_ttl = cfg['negative-ttl']
+        self._not_found = {}
+        self._stale_while_revalidate = cfg['stale-while-revalidate']
+        self._revalidating = set()
+        self._revalidating_lock = threading.Lock()
+
+    def page_url(self, project):
+        return f'{self.url}{project}/'
+
+    def get(self, project, cache_key, html=False):
+        expires = self._not_found.get(cache_key)
+        if expires:
+            if expires > time.monotonic():
+                metrics.page_cache.inc('negative')
+                return None
+            self._not_found.pop(cache_key, None)
+        # HTML clients get upstream HTML, which can be streamed through
+        page_key = cache_key + '.html' if html else cache_key
+        entry = self._cache.get(page_key) if self._cache else None
+        if entry and (entry.fresh or self._stale_while_revalidate):
+            if entry.fresh:
+                metrics.page_cache.inc('hit')
+            else:
+                metrics.page_cache.inc('stale')
+                self._revalidate(project, cache_key, page_key, entry)
+            return (entry.text,), entry.content_type
+        return self._fetch(project, cache_key, page_key, entry)
+
+    def _fetch(self, project, cache_key, page_key, entry):
+        accept = pages.ACCEPT if page_key == cache_key else pages.HTML_ACCEPT
+        headers = dict(conditional_headers(entry), Accept=accept)
+        try:
+            response = self._client.get(self.page_url(project), headers,
+                                        stream=True)
+        except (requests.ConnectionError, requests.Timeout):
+            if entry:
+                metrics.page_cache.inc('fallback')
+                return (entry.text,), entry.content_type
+            return None
+        except Exception as ex:
+            msg = str(ex)
+            cherrypy.log(msg)
+            raise cherrypy.HTTPError(message=msg)
+        if response.status_code != requests.codes.OK:
+            response.close()
+        if response.status_code == requests.codes.NOT_FOUND:
+            metrics.page_cache.inc('not_found')
+            if self._negative_ttl:
+                now = time.monotonic()
+                if len(self._not_found) >= _NOT_FOUND_MAX:
+                    self._not_found = {key: expires for key, expires
+                                       in self._not_found.items()
+                                       if expires > now}
+                self._not_found[cache_key] = now + self._negative_ttl
+            return None
+        elif entry and response.status_code == requests.codes.NOT_MODIFIED:
+            metrics.page_cache.inc('revalidated')
+            self._cache.touch(page_key)
+            return (entry.text,), entry.content_type
+        elif response.status_code == requests.codes.OK:
+            metrics.page_cache.inc('fetched')
+            content_type = response.headers.get('Content-Type')
+            chunks = self._stream(response, page_key, content_type)
+            return chunks, content_type
+        elif entry and response.status_code >= 500:
+            metrics.page_cache.inc('fallback')
+            return (entry.text,), entry.content_type
+        else:
+            raise cherrypy.HTTPError(response.status_code)
+
+    def _stream(self, response, page_key, content_type):
+        if response.encoding is None:
+            response.encoding = 'utf-8'
+        writer = self._cache.writer(page_key) if self._cache else None
+        try:
+            for chunk in response.iter_content(_CHUNK_SIZE,
+                                               decode_unicode=True):
+                if writer:
+                    writer.write(chunk)
+                yield chunk
+            if writer:
+                writer.commit(content_type, response.headers.get('ETag'),
+                              response.headers.get('Last-Modified'))
+                writer = None
+        finally:
+            response.close()
+            if writer:
+                writer.discard()
+
+    def _revalidate(self, project, cache_key, page_key, entry):
+        with self._revalidating_lock:
+            if page_key in self._revalidating:
+                return
+            self._revalidating.add(page_key)
+
+        def revalidate():
+            try:
+                page = self._fetch(project, cache_key, page_key, entry)
+                for _ in page[0] if page else ():
+                    pass
+            except Exception as ex:
+                cherrypy.log(f'revalidate {project}: {ex}')
+            finally:
+                with self._revalidating_lock:
+                    self._revalidating.discard(page_key)
+        threading.Thread(target=revalidate, daemon=True).start()
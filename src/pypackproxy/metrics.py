@@ -0,0 +1,167 @@
+import threading
+import time
+from bisect import bisect_left
+
+import cherrypy
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ROUTES = ('simple', 'packs', 'storage', 'admin', 'upload', 'metrics')
+_registry = []
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def samples(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} {self.type}']
+        for label_values, value in sorted(self.samples()):
+            lines.append(f'{self.name}{_labels(self.labels, label_values)}'
+                         f' {_number(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = (
+                self._values.get(label_values, 0) + amount)
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help, func=None):
+        super().__init__(name, help)
+        self.func = func
+
+    def samples(self):
+        return [((), self.func())] if self.func else []
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def observe(self, value, *label_values):
+        i = bisect_left(BUCKETS, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (
+                    len(BUCKETS) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            samples = sorted((k, list(v)) for k, v in self._values.items())
+        for label_values, counts in samples:
+            total = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), counts):
+                total += count
+                labels = _labels(self.labels + ('le',),
+                                 label_values + (str(bound),))
+                lines.append(f'{self.name}_bucket{labels} {total}')
+            labels = _labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {_number(counts[-1])}')
+            lines.append(f'{self.name}_count{labels} {total}')
+        return lines
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"'
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+requests_total = Counter('pypackproxy_requests_total',
+                         'HTTP requests handled.', ('route', 'status'))
+request_duration = Histogram('pypackproxy_request_duration_seconds',
+                             'HTTP request latency.', ('route',))
+upstream_duration = Histogram('pypackproxy_upstream_duration_seconds',
+                              'Upstream request latency.', ('host',))
+upstream_errors = Counter('pypackproxy_upstream_errors_total',
+                          'Failed upstream requests.', ('host', 'kind'))
+page_cache = Counter('pypackproxy_page_cache_total',
+                     'Upstream index page lookups by result.', ('result',))
+bytes_total = Counter('pypackproxy_bytes_total',
+                      'Package bytes served from storage or fetched'
+                      ' upstream.', ('source',))
+downloads_in_flight = Gauge('pypackproxy_downloads_in_flight',
+                            'Upstream downloads in progress.')
+storage_bytes = Gauge('pypackproxy_storage_bytes',
+                      'Size of the package files in the storage.')
+storage_files = Gauge('pypackproxy_storage_files',
+                      'Number of package files in the storage.')
+
+
+class _MetricsTool(cherrypy.Tool):
+    def __init__(self):
+        super().__init__('on_start_resource', self._start)
+
+    def _setup(self):
+        super()._setup()
+        cherrypy.serving.request.hooks.attach('on_end_request', self._end)
+
+    @staticmethod
+    def _start():
+        cherrypy.serving.request.metrics_start = time.perf_counter()
+
+    @staticmethod
+    def _end():
+        request = cherrypy.serving.request
+        response = cherrypy.serving.response
+        start = getattr(request, 'metrics_start', None)
+        if start is None:
+            return
+        # path_info is relative to the app, /simple and /packs are apps
+        route = (request.script_name + request.path_info).split('/', 2)[1]
+        if route not in ROUTES:
+            route = 'other'
+        status = str(response.status)[:3]
+        requests_total.inc(route, status)
+        request_duration.observe(time.perf_counter() - start, route)
+        if (status in ('200', '206') and
+                (route == 'storage' or
+                 getattr(request, 'from_storage', False))):
+            length = response.headers.get('Content-Length')
+            if length:
+                bytes_total.inc('storage', amount=int(length))
+
+
+cherrypy.tools.metrics = _MetricsTool()
@@ -1,56 +1,499 @@
+import fcntl
+import hashlib
 import os
-from posixpath import join as path_join
+import threading
+from collections import namedtuple
 from urllib.parse import unquote as urlunquote
 
 import cherrypy
 import requests
+from cherrypy.lib import cptools, static
 
-from . import root, PACKS_PATH
+from . import metrics, root, tracing, PACKS_PATH
+from .blobs import BlobStore
+from .utils import write_atomic
 
 path = PACKS_PATH
 config = {'/': {}}
-root_storage = path_join(root.path, root.storage)
-chunk_size = 8192
+protocols = ('http:', 'https:')
+_downloads = {}
+_downloads_lock = threading.Lock()
+_Settings = namedtuple('_Settings',
+                       'chunk_size parts parallel_min retries blobs')
+_TRANSIENT_ERRORS = (requests.ConnectionError, requests.Timeout,
+                     requests.exceptions.ChunkedEncodingError)
+_HASH_BUFFER = 1 << 20
+metrics.downloads_in_flight.func = lambda: len(_downloads)
 
 
 class Packs:
-    def __init__(self, cfg):
+    def __init__(self, cfg, client, index):
         self._storage = cfg['storage-path']
-        self._proxies = cfg['proxies']
-        self._timeout = cfg['timeout']
-        self._headers = {'User-Agent': cfg['user-agent']}
+        self._settings = settings(cfg)
+        self._client = client
+        self._index = index
 
     @cherrypy.expose
-    def default(self, project, proto, *args):
-        if proto not in ('http:', 'https:') and args:
+    def default(self, project, *args):
+        digest = None
+        if args and args[0] not in protocols:
+            digest, *args = args
+        if len(args) < 2 or args[0] not in protocols:
             raise cherrypy.HTTPError(requests.codes.BAD_REQUEST)
+        proto, *args = args
         file = args[-1]
+        if file.endswith(root.metadata_ext):
+            digest = None
+        if project.startswith('.') or file.startswith('.'):
+            raise cherrypy.HTTPError(requests.codes.BAD_REQUEST)
         file_path = os.path.join(self._storage, project, file)
-        if not os.path.exists(file_path):
+        leader = False
+        with _downloads_lock:
+            download = _downloads.get(file_path)
+            if download is None and not os.path.exists(file_path):
+                download = _downloads[file_path] = _Download(
+                    file_path, lambda: self._index.update(project, file),
+                    self._settings)
+                leader = True
+        if download is None:
+            return self._serve(project, file, file_path)
+        if leader:
             url = f'{proto}//{urlunquote("/".join(args))}'
+            download.start(self._client, url, digest)
+        with tracing.phase('upstream'):
+            headers = download.wait_headers()
+        if headers is None:
+            return self._serve(project, file, file_path)
+        cherrypy.response.headers.update(headers)
+        cherrypy.response.stream = True
+        return download.stream()
+
+    def _serve(self, project, file, file_path):
+        with tracing.phase('storage'):
+            self._index.touch(project, file)
+            cherrypy.serving.request.from_storage = True
+            stored_file = self._index.get(project, file)
+            if stored_file and stored_file.hashes:
+                etag = f'"{stored_file.hashes["sha256"]}"'
+                request_headers = cherrypy.request.headers
+                if request_headers.get('If-Range', etag) != etag:
+                    request_headers.pop('Range', None)
+                cherrypy.response.headers['ETag'] = etag
+                cptools.validate_etags()
+            return static.serve_file(file_path)
+
+
+def fetch(cfg, client, index, project, url, digest=None):
+    file = urlunquote(url.rsplit('/', 1)[-1])
+    file_path = os.path.join(cfg['storage-path'], project, file)
+    if os.path.exists(file_path):
+        return None
+    download = _Download(file_path, lambda: index.update(project, file),
+                         settings(cfg))
+    download.start(client, url, digest)
+    return download.wait()
+
+
+def settings(cfg):
+    return _Settings(cfg['download-chunk-size'], cfg['download-parts'],
+                     cfg['download-parallel-min'], cfg['retries'],
+                     BlobStore(cfg['storage-path'])
+                     if cfg['content-addressed'] else None)
+
+
+class _Download:
+    def __init__(self, file_path, on_success, settings):
+        self._file_path = file_path
+        self._on_success = on_success
+        self._settings = settings
+        self._blobs = settings.blobs
+        self._tmp_path = None
+        self._cond = threading.Condition()
+        self._headers = None
+        self._size = 0
+        self._offset = 0
+        self._length = None
+        self._parts = None
+        self._done = False
+        self._error = None
+
+    def start(self, client, url, digest=None):
+        try:
+            self._start(client, url, digest)
+        except BaseException as ex:
+            # later requests for the file must not wait for this one
+            if not self._done:
+                self._finish(cherrypy.HTTPError(message=str(ex)))
+            raise
+
+    def _start(self, client, url, digest):
+        try:
+            hashes = _Hashes(digest)
+        except ValueError as ex:
+            self._finish(cherrypy.HTTPError(requests.codes.BAD_REQUEST))
+            raise cherrypy.HTTPError(requests.codes.BAD_REQUEST, str(ex))
+        try:
+            fh = self._claim()
+        except OSError as ex:
+            self._finish(cherrypy.HTTPError(message=str(ex)))
+            raise
+        if fh is None:
+            self._finish()
+            return
+        if self._link_blob(hashes.expected_sha256):
+            self._abort(fh)
+            return
+        self._client = client
+        self._url = url
+        # a partial file from an earlier attempt is only resumed when the
+        # result can be verified against the digest
+        offset = fh.seek(0, os.SEEK_END) if hashes.expected else 0
+        try:
+            r = client.get(url, {'Range': f'bytes={offset}-'}
+                           if offset else None, stream=True)
+            if (offset and r.status_code ==
+                    requests.codes.REQUESTED_RANGE_NOT_SATISFIABLE):
+                # the partial file may be complete, e.g. after a crash
+                # before it was renamed
+                r.close()
+                if self._complete(fh, offset, hashes):
+                    return
+                cherrypy.log(f'{url}: discarding partial file')
+                hashes = _Hashes(digest)
+                offset = 0
+                r = client.get(url, stream=True)
+        except Exception as ex:
+            msg = str(ex)
+            cherrypy.log(msg)
+            self._abort(fh, cherrypy.HTTPError(message=msg),
+                        keep=hashes.expected)
+            raise cherrypy.HTTPError(message=msg)
+        if offset and r.status_code == requests.codes.PARTIAL_CONTENT:
+            cherrypy.log(f'{url}: resuming at {offset}')
+            _hash_file(self._tmp_path, offset, hashes)
+            self._size = self._offset = offset
+            self._length = _total_length(r)
+        elif r.status_code == requests.codes.OK:
+            fh.seek(0)
+            fh.truncate()
+            if 'Content-Length' in r.headers:
+                self._length = int(r.headers['Content-Length'])
+        else:
+            r.close()
+            self._abort(fh, cherrypy.HTTPError(r.status_code),
+                        keep=hashes.expected)
+            raise cherrypy.HTTPError(r.status_code)
+        etag = r.headers.get('ETag')
+        self._etag = etag if etag and not etag.startswith('W/') else None
+        headers = {'Content-Type': r.headers.get('Content-Type',
+                                                 'application/octet-stream')}
+        if self._length is not None:
+            headers['Content-Length'] = str(self._length)
+        with self._cond:
+            self._headers = headers
+            self._cond.notify_all()
+        threading.Thread(target=tracing.wrap(self._fetch),
+                         args=(r, fh, hashes),
+                         daemon=True).start()
+
+    def wait_headers(self):
+        with self._cond:
+            while self._headers is None and not self._done:
+                self._cond.wait()
+            if self._error:
+                raise self._error
+            return self._headers
+
+    def wait(self):
+        with self._cond:
+            while not self._done:
+                self._cond.wait()
+            if self._error:
+                raise self._error
+            return self._size - self._offset
+
+    def stream(self):
+        # unbuffered, a read-ahead past the streamable prefix would return
+        # holes that parallel parts have not been written to yet
+        try:
+            fh = open(self._tmp_path, 'rb', buffering=0)
+        except FileNotFoundError:
+            fh = open(self._file_path, 'rb', buffering=0)
+        with fh:
+            while True:
+                with self._cond:
+                    while self._size == fh.tell() and not self._done:
+                        self._cond.wait()
+                    available = self._size - fh.tell()
+                    if available <= 0:
+                        if self._error:
+                            raise self._error
+                        return
+                yield fh.read(min(available, self._settings.chunk_size))
+
+    def _claim(self):
+        dir_path, file = os.path.split(self._file_path)
+        os.makedirs(dir_path, exist_ok=True)
+        self._tmp_path = os.path.join(dir_path, f'.{file}.part')
+        while True:
+            fd = os.open(self._tmp_path, os.O_RDWR | os.O_CREAT, 0o644)
             try:
-                r = requests.get(url, stream=True,
-                                 headers=self._headers,
-                                 proxies=self._proxies,
-                                 timeout=self._timeout)
-            except Exception as ex:
-                msg = str(ex)
-                cherrypy.log(msg)
-                raise cherrypy.HTTPError(message=msg)
-            if r.status_code == requests.codes.OK:
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                resp_headers = cherrypy.response.headers
-                resp_headers['Content-Type'] = r.headers['Content-Type']
-                resp_headers['Content-Length'] = r.headers['Content-Length']
-                return _content(r, file_path)
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # another worker process is downloading this file
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                os.close(fd)
+                if os.path.exists(self._file_path):
+                    return None
+                continue
+            try:
+                claimed = os.path.samestat(os.fstat(fd),
+                                           os.stat(self._tmp_path))
+            except FileNotFoundError:
+                claimed = False
+            if not claimed:
+                # locked a part file that was renamed or removed meanwhile
+                os.close(fd)
+                continue
+            if os.path.exists(self._file_path):
+                if not os.fstat(fd).st_size:
+                    os.remove(self._tmp_path)
+                os.close(fd)
+                return None
+            return os.fdopen(fd, 'wb')
+
+    def _fetch(self, r, fh, hashes):
+        try:
+            self._fetch_file(r, fh, hashes)
+        finally:
+            if not self._done:
+                self._finish(cherrypy.HTTPError(message='download failed'))
+
+    def _fetch_file(self, r, fh, hashes):
+        try:
+            if (self._settings.parts > 1 and not self._offset and
+                    self._length is not None and
+                    self._length >= self._settings.parallel_min and
+                    r.headers.get('Accept-Ranges') == 'bytes'):
+                self._fetch_parts(r, fh)
+                _hash_file(self._tmp_path, self._length, hashes)
             else:
-                raise cherrypy.HTTPError(r.status_code)
+                self._fetch_stream(r, fh, hashes)
+            hashes.verify()
+            self._store(fh, hashes)
+        except Exception as ex:
+            cherrypy.log(f'{self._url}: {ex}')
+            try:
+                os.remove(self._file_path + root.hash_ext)
+            except OSError:
+                pass
+            self._abort(fh, ex, keep=hashes.expected and
+                        self._parts is None and
+                        isinstance(ex, _TRANSIENT_ERRORS))
         else:
-            raise cherrypy.HTTPRedirect(path_join(root_storage, project, file))
+            self._finish()
+
+    def _complete(self, fh, length, hashes):
+        _hash_file(self._tmp_path, length, hashes)
+        try:
+            hashes.verify()
+        except ValueError:
+            return False
+        self._size = self._offset = length
+        self._store(fh, hashes)
+        self._finish()
+        return True
+
+    def _store(self, fh, hashes):
+        project_path = os.path.dirname(self._file_path)
+        with root.project_lock(project_path):
+            write_atomic(self._file_path + root.hash_ext, hashes.sha256)
+            os.replace(self._tmp_path, self._file_path)
+            if self._blobs:
+                self._blobs.add(hashes.sha256, self._file_path)
+        fh.close()
+        root.extract_metadata(self._file_path)
+        self._on_success()
+
+    def _fetch_stream(self, r, fh, hashes):
+        retries = self._settings.retries
+        while True:
+            try:
+                if r is None:
+                    r = self._range(self._size)
+                with r:
+                    for chunk in r.iter_content(self._settings.chunk_size):
+                        fh.write(chunk)
+                        fh.flush()
+                        hashes.update(chunk)
+                        with self._cond:
+                            self._size += len(chunk)
+                            self._cond.notify_all()
+                if self._length is None or self._size >= self._length:
+                    return
+                raise requests.ConnectionError('connection closed early')
+            except _TRANSIENT_ERRORS as ex:
+                r = None
+                if not retries or self._length is None:
+                    raise
+                retries -= 1
+                cherrypy.log(f'{self._url}: {ex} (resume at {self._size})')
+
+    def _fetch_parts(self, r, fh):
+        part_size = -(-self._length // self._settings.parts)
+        self._parts = [[start, min(start + part_size, self._length)]
+                       for start in range(0, self._length, part_size)]
+        errors = []
+        threads = [threading.Thread(target=tracing.wrap(self._fetch_part),
+                                    args=(part, r if i == 0 else None,
+                                          fh.fileno(), errors),
+                                    daemon=True)
+                   for i, part in enumerate(self._parts)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _fetch_part(self, part, r, fd, errors):
+        end = part[1]
+        retries = self._settings.retries
+        while part[0] < end and not errors:
+            try:
+                if r is None:
+                    r = self._range(part[0], end)
+                with r:
+                    for chunk in r.iter_content(self._settings.chunk_size):
+                        chunk = chunk[:end - part[0]]
+                        os.pwrite(fd, chunk, part[0])
+                        with self._cond:
+                            part[0] += len(chunk)
+                            self._size = self._prefix()
+                            self._cond.notify_all()
+                        if part[0] >= end or errors:
+                            break
+                r = None
+                if part[0] < end and not errors:
+                    raise requests.ConnectionError('connection closed early')
+            except _TRANSIENT_ERRORS as ex:
+                r = None
+                if not retries:
+                    errors.append(ex)
+                    return
+                retries -= 1
+                cherrypy.log(f'{self._url}: {ex} (resume at {part[0]})')
+            except Exception as ex:
+                errors.append(ex)
+                return
+
+    def _prefix(self):
+        # the part boundaries are adjacent, so the first incomplete part
+        # ends the contiguous prefix that can be streamed to clients
+        for position, end in self._parts:
+            if position < end:
+                return position
+        return self._length
+
+    def _range(self, start, end=None):
+        headers = {'Range': f'bytes={start}-{"" if end is None else end - 1}'}
+        if self._etag:
+            headers['If-Range'] = self._etag
+        r = self._client.get(self._url, headers, stream=True)
+        if r.status_code != requests.codes.PARTIAL_CONTENT:
+            r.close()
+            raise requests.ConnectionError(
+                f'range request failed: {r.status_code}')
+        return r
+
+    def _link_blob(self, sha256):
+        if not (self._blobs and sha256):
+            return False
+        project_path = os.path.dirname(self._file_path)
+        try:
+            with root.project_lock(project_path):
+                if not self._blobs.link(sha256, self._file_path):
+                    return False
+                write_atomic(self._file_path + root.hash_ext, sha256)
+        except OSError as ex:
+            cherrypy.log(f'blob store: {ex}', 'WARNING')
+            return False
+        root.extract_metadata(self._file_path)
+        self._on_success()
+        return True
+
+    def _abort(self, fh, error=None, keep=False):
+        try:
+            # an empty part file is only a leftover claim
+            if not keep or not os.stat(self._tmp_path).st_size:
+                os.remove(self._tmp_path)
+        except OSError:
+            pass
+        try:
+            fh.close()
+        finally:
+            self._finish(error)
+
+    def _finish(self, error=None):
+        metrics.bytes_total.inc('upstream', amount=self._size - self._offset)
+        with _downloads_lock:
+            _downloads.pop(self._file_path, None)
+        with self._cond:
+            self._done = True
+            self._error = error
+            self._cond.notify_all()
+
+
+class _Hashes:
+    def __init__(self, digest):
+        self._sha256 = hashlib.sha256()
+        self._expected = None
+        self._other = None
+        if digest:
+            name, _, value = digest.partition('=')
+            if name not in hashlib.algorithms_guaranteed or not value:
+                raise ValueError(f'unsupported digest: {digest}')
+            self._expected = name, value.lower()
+            if name != 'sha256':
+                self._other = hashlib.new(name)
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+    @property
+    def expected(self):
+        return self._expected is not None
+
+    @property
+    def expected_sha256(self):
+        if self._expected and self._expected[0] == 'sha256':
+            return self._expected[1]
+        return None
+
+    def update(self, data):
+        self._sha256.update(data)
+        if self._other:
+            self._other.update(data)
+
+    def verify(self):
+        if self._expected:
+            name, value = self._expected
+            actual = (self._other or self._sha256).hexdigest()
+            if actual != value:
+                raise ValueError(f'{name} mismatch: {actual} != {value}')
+
+
+def _hash_file(file_path, length, hashes):
+    with open(file_path, 'rb') as fh:
+        while length > 0:
+            data = fh.read(min(length, _HASH_BUFFER))
+            if not data:
+                raise ValueError(f'{file_path}: unexpected end of file')
+            hashes.update(data)
+            length -= len(data)
 
 
-def _content(r, file_path):
-    with open(file_path, 'wb') as fh:
-        for chunk in r.iter_content(chunk_size=chunk_size):
-            fh.write(chunk)
-            yield chunk
+def _total_length(r):
+    total = r.headers.get('Content-Range', '').rpartition('/')[2]
+    return int(total) if total.isdigit() else None
@@ -0,0 +1,158 @@
+import json
+from html import escape
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urldefrag
+
+JSON_TYPE = 'application/vnd.pypi.simple.v1+json'
+HTML_TYPE = 'application/vnd.pypi.simple.v1+html'
+TEXT_HTML_TYPE = 'text/html'
+ACCEPT = f'{JSON_TYPE}, {HTML_TYPE};q=0.2, {TEXT_HTML_TYPE};q=0.01'
+HTML_ACCEPT = f'{HTML_TYPE}, {TEXT_HTML_TYPE};q=0.9, {JSON_TYPE};q=0.01'
+HTML_TAIL = '</body></html>\n'
+
+_FILE_KEYS = {'filename', 'url', 'hashes', 'requires-python', 'core-metadata',
+              'dist-info-metadata', 'yanked', 'size', 'upload-time'}
+_MEDIA_TYPES = {
+    JSON_TYPE: JSON_TYPE,
+    'application/vnd.pypi.simple.latest+json': JSON_TYPE,
+    HTML_TYPE: HTML_TYPE,
+    'application/vnd.pypi.simple.latest+html': HTML_TYPE,
+    TEXT_HTML_TYPE: TEXT_HTML_TYPE,
+    'text/*': TEXT_HTML_TYPE,
+    '*/*': TEXT_HTML_TYPE,
+}
+
+
+def negotiate(accept_elements):
+    if not accept_elements:
+        return TEXT_HTML_TYPE
+    for element in accept_elements:
+        if element.qvalue > 0 and element.value in _MEDIA_TYPES:
+            return _MEDIA_TYPES[element.value]
+    return None
+
+
+def is_json(content_type):
+    return bool(content_type) and content_type.startswith(JSON_TYPE)
+
+
+def parse(chunks, content_type, base_url):
+    if is_json(content_type):
+        data = json.loads(''.join(chunks))
+        for file in data['files']:
+            file['url'] = urljoin(base_url, file['url'])
+            metadata = file.pop('dist-info-metadata', False)
+            metadata = file.pop('core-metadata', metadata)
+            if metadata:
+                file['core-metadata'] = metadata
+        return data['files'], data.get('versions', [])
+    parser = AnchorParser(base_url)
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+    return parser.pop_files(), []
+
+
+def render_html(project, files):
+    return ''.join((html_head(project),
+                    *(render_anchor(file) for file in files), HTML_TAIL))
+
+
+def html_head(project):
+    return _HTML_HEAD % dict(project=escape(project))
+
+
+def render_anchor(file):
+    url = file['url']
+    hashes = file.get('hashes')
+    if hashes:
+        name = 'sha256' if 'sha256' in hashes else next(iter(hashes))
+        url += f'#{name}={hashes[name]}'
+    attrs = [f'href="{escape(url)}"']
+    if file.get('requires-python'):
+        attrs.append(
+            f'data-requires-python="{escape(file["requires-python"])}"')
+    metadata = file.get('core-metadata')
+    if metadata:
+        if isinstance(metadata, dict) and metadata:
+            name = 'sha256' if 'sha256' in metadata else next(iter(metadata))
+            value = f'{name}={metadata[name]}'
+        else:
+            value = 'true'
+        attrs.append(f'data-core-metadata="{escape(value)}"')
+        attrs.append(f'data-dist-info-metadata="{escape(value)}"')
+    yanked = file.get('yanked')
+    if yanked:
+        reason = yanked if isinstance(yanked, str) else ''
+        attrs.append(f'data-yanked="{escape(reason)}"')
+    for key, value in file.items():
+        if key not in _FILE_KEYS and isinstance(value, (str, int, float)):
+            if isinstance(value, bool):
+                value = str(value).lower()
+            attrs.append(f'data-{escape(key)}="{escape(str(value))}"')
+    return f'<a {" ".join(attrs)}>{escape(file["filename"])}</a><br>\n'
+
+
+def render_json(project, files, versions):
+    for file in files:
+        if file.get('core-metadata'):
+            file['dist-info-metadata'] = file['core-metadata']
+    data = {'meta': {'api-version': '1.0'}, 'name': project, 'files': files}
+    if all('size' in file for file in files):
+        data['meta']['api-version'] = '1.1'
+        data['versions'] = versions
+    return json.dumps(data)
+
+
+class AnchorParser(HTMLParser):
+    def __init__(self, base_url):
+        super().__init__()
+        self._base_url = base_url
+        self._file = None
+        self._files = []
+
+    def pop_files(self):
+        files, self._files = self._files, []
+        return files
+
+    def handle_starttag(self, tag, attrs):
+        if tag != 'a':
+            return
+        attrs = dict(attrs)
+        if not attrs.get('href'):
+            return
+        url, fragment = urldefrag(urljoin(self._base_url, attrs['href']))
+        file = {'filename': '', 'url': url, 'hashes': {}}
+        name, _, value = fragment.partition('=')
+        if value:
+            file['hashes'][name] = value
+        if attrs.get('data-requires-python'):
+            file['requires-python'] = attrs['data-requires-python']
+        metadata = attrs.get('data-core-metadata',
+                             attrs.get('data-dist-info-metadata'))
+        if metadata and metadata != 'false':
+            name, _, value = metadata.partition('=')
+            file['core-metadata'] = {name: value} if value else True
+        if 'data-yanked' in attrs:
+            file['yanked'] = attrs['data-yanked'] or True
+        for name, value in attrs.items():
+            if name.startswith('data-') and name[5:] not in _FILE_KEYS:
+                file[name[5:]] = value
+        self._file = file
+
+    def handle_data(self, data):
+        if self._file is not None:
+            self._file['filename'] += data
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self._file is not None:
+            self._file['filename'] = self._file['filename'].strip()
+            self._files.append(self._file)
+            self._file = None
+
+
+_HTML_HEAD = '''<!DOCTYPE html>
+<html><head><meta name="pypi:repository-version" content="1.0">
+<title>Links for %(project)s</title></head><body>
+<h1>Links for %(project)s</h1>
+'''
@@ -1,6 +1,6 @@
 from jinja2 import Environment, PackageLoader
 
-from . import PYPP_DEBUG, PROG_NAME, __version__
+from . import tracing, PYPP_DEBUG, PROG_NAME, __version__
 
 
 def init():
@@ -10,6 +10,7 @@ def init():
 
 
 def render(name, **data):
-    return _env.get_template(name).render(progname=PROG_NAME,
-                                          progversion=__version__,
-                                          **data)
+    with tracing.phase('render'):
+        return _env.get_template(name).render(progname=PROG_NAME,
+                                              progversion=__version__,
+                                              **data)
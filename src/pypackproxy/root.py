@@ -1,18 +1,24 @@
 import hashlib
+import hmac
 import os
 import re
 import shutil
+import zipfile
 from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime
 from posixpath import join as path_join
 
 import cherrypy
-from packaging.version import parse as parse_version
-from salmagundi.files import write_all
+from cherrypy._cpreqbody import Part
+from cherrypy.lib import auth_basic
+from packaging.utils import canonicalize_name
+from salmagundi.files import read_all, write_all
 from salmagundi.strings import format_bin_prefix
 
-from . import ROOT_PATH
-from .utils import get_favicon_path
+from . import metrics, PROG_NAME, ROOT_PATH
+from .blobs import BlobStore, release_blob
+from .utils import file_lock, get_favicon_path, temp_file, write_atomic
 from .renderer import render
 
 ProjectFile = namedtuple('ProjectFile', 'name url size mtime')
@@ -33,19 +39,184 @@ config = {
 proj_nam_re = re.compile('^([A-Z0-9]|[A-Z0-9][A-Z0-9._-]*[A-Z0-9])$',
                          re.IGNORECASE)
 hash_ext = '.sha256'
-chunk_size = 8192
+metadata_ext = '.metadata'
+upload_ext = '.upload'
+sidecar_exts = (hash_ext, metadata_ext, metadata_ext + hash_ext, upload_ext)
+lock_dir = '.locks'
+session_dir = '.sessions'
+pages_dir = '.pages'
+quarantine_dir = '.quarantine'
+scrub_state = '.scrub.json'
+uploads_dir = '.uploads'
 project_path = path_join(path, '/project/')
 
 
+def is_artifact(name):
+    return not (name.startswith('.') or name.endswith(hash_ext) or
+                name.endswith(metadata_ext) or name.endswith(upload_ext))
+
+
+@contextmanager
+def project_lock(project_path):
+    storage_path, project = os.path.split(project_path)
+    lock_path = os.path.join(storage_path, lock_dir)
+    os.makedirs(lock_path, exist_ok=True)
+    with file_lock(os.path.join(lock_path, project)):
+        yield
+
+
+def extract_metadata(file_path):
+    if not file_path.endswith('.whl'):
+        return
+    try:
+        with zipfile.ZipFile(file_path) as zf:
+            for name in zf.namelist():
+                parts = name.split('/')
+                if (len(parts) == 2 and parts[0].endswith('.dist-info') and
+                        parts[1] == 'METADATA'):
+                    data = zf.read(name)
+                    break
+            else:
+                return
+        write_atomic(file_path + metadata_ext, data)
+        write_atomic(file_path + metadata_ext + hash_ext,
+                     hashlib.sha256(data).hexdigest())
+    except (OSError, zipfile.BadZipFile) as ex:
+        cherrypy.log(f'{file_path}: {ex}', 'WARNING')
+
+
+def remove_file(file_path):
+    sha256 = _read_hash(file_path)
+    os.remove(file_path)
+    for ext in sidecar_exts:
+        if os.path.exists(file_path + ext):
+            os.remove(file_path + ext)
+    if sha256:
+        release_blob(os.path.dirname(os.path.dirname(file_path)), sha256)
+
+
+def _read_hash(file_path):
+    try:
+        return read_all(file_path + hash_ext).strip()
+    except FileNotFoundError:
+        return None
+
+
+def _record_access(index):
+    if str(cherrypy.response.status)[:3] not in ('200', '206', '304'):
+        return
+    parts = cherrypy.request.path_info[len(storage) + 1:].split('/')
+    if len(parts) == 2:
+        index.touch(*parts)
+
+
+cherrypy.tools.storage_access = cherrypy.Tool('on_end_request',
+                                              _record_access)
+
+
+class UploadFile:
+    """Temporary file in the storage that hashes the data written to it."""
+
+    def __init__(self, dir_path):
+        self._fh, self.path = temp_file(dir_path)
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self._fh.write(data)
+        self._sha256.update(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._fh.seek(offset, whence)
+
+    def close(self):
+        self._fh.close()
+
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+    def commit(self, file_path):
+        self._fh.close()
+        os.replace(self.path, file_path)
+
+    def discard(self):
+        self._fh.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class _UploadPart(Part):
+    def make_file(self):
+        if not self.filename:
+            return super().make_file()
+        request = cherrypy.serving.request
+        upload = UploadFile(request.upload_path)
+        request.uploads.append(upload)
+        return upload
+
+
+def _stream_uploads(upload_path, checkpassword=None):
+    if checkpassword:
+        auth_basic.basic_auth(PROG_NAME, checkpassword)
+    request = cherrypy.serving.request
+    request.upload_path = upload_path
+    request.uploads = []
+    request.body.part_class = _UploadPart
+    request.hooks.attach('on_end_request', _discard_uploads)
+
+
+def _discard_uploads():
+    for upload in cherrypy.serving.request.uploads:
+        upload.discard()
+
+
+# file parts go directly into the storage instead of a spooled temp file
+cherrypy.tools.stream_uploads = cherrypy.Tool('before_request_body',
+                                              _stream_uploads)
+
+
 class Root:
-    def __init__(self, cfg):
+    def __init__(self, cfg, index):
         if cfg['admin-pass']:
             self._password = cfg['admin-pass']
             config['/admin'] = {'tools.sessions.on': True,
                                 'tools.sessions.name': 'admin_session_id',
                                 'tools.sessions.timeout': cfg['admin-expire']}
+            if cfg['workers'] > 1:
+                session_path = os.path.join(cfg['storage-path'], session_dir)
+                os.makedirs(session_path, exist_ok=True)
+                config['/admin'].update({
+                    'tools.sessions.storage_class':
+                        cherrypy.lib.sessions.FileSession,
+                    'tools.sessions.storage_path': session_path})
+        config[storage].update({'tools.storage_access.on': True,
+                                'tools.storage_access.index': index})
+        if cfg['gzip-level']:
+            config['/'].update({'tools.gzip.on': True,
+                                'tools.gzip.compress_level': cfg['gzip-level'],
+                                'tools.gzip.mime_types': ['text/html',
+                                                          'text/plain']})
+            config[storage]['tools.gzip.on'] = False
+        self._metrics_enabled = cfg['metrics']
+        if self._metrics_enabled:
+            metrics.storage_bytes.func = index.size
+            metrics.storage_files.func = index.count
         self._admin_enabled = bool(cfg['admin-pass'])
         self._storage = cfg['storage-path']
+        upload_path = os.path.join(self._storage, uploads_dir)
+        os.makedirs(upload_path, exist_ok=True)
+        if self._admin_enabled:
+            config['/admin'].update({'tools.stream_uploads.on': True,
+                                     'tools.stream_uploads.upload_path':
+                                         upload_path})
+        self._upload_tokens = cfg['upload-tokens']
+        if self._upload_tokens:
+            config['/upload'] = {
+                'tools.stream_uploads.on': True,
+                'tools.stream_uploads.upload_path': upload_path,
+                'tools.stream_uploads.checkpassword': self._check_token}
+        self._blobs = (BlobStore(self._storage)
+                       if cfg['content-addressed'] else None)
+        self._index = index
         self._project_url = cfg['project-url']
 
     @cherrypy.expose
@@ -53,7 +224,7 @@ class Root:
         return render(
             'index.html', admin_enabled=self._admin_enabled,
             project_base_url=project_path if self._project_url else None,
-            projects=sorted(os.listdir(self._storage)))
+            projects=self._index.projects())
 
     @cherrypy.expose
     def project(self, project):
@@ -62,6 +233,39 @@ class Root:
         else:
             raise cherrypy.HTTPError(404)
 
+    @cherrypy.expose
+    def metrics(self):
+        if not self._metrics_enabled:
+            raise cherrypy.HTTPError(404)
+        cherrypy.response.headers['Content-Type'] = metrics.CONTENT_TYPE
+        return metrics.render()
+
+    @cherrypy.expose
+    def upload(self, content=None, **params):
+        if not self._upload_tokens:
+            raise cherrypy.HTTPError(404)
+        if cherrypy.request.method != 'POST':
+            raise cherrypy.HTTPError(405)
+        if params.get(':action') != 'file_upload':
+            raise cherrypy.HTTPError(400, 'Unsupported action')
+        name = params.get('name', '')
+        if not isinstance(getattr(content, 'file', None), UploadFile):
+            raise cherrypy.HTTPError(400, 'No file content')
+        filename = content.filename
+        if (os.path.basename(filename) != filename or
+                not is_artifact(filename) or
+                not canonicalize_name(filename).startswith(
+                    canonicalize_name(name) + '-')):
+            raise cherrypy.HTTPError(400, f'Invalid file name: {filename}')
+        sha256 = content.file.sha256()
+        digest = params.get('sha256_digest')
+        if digest and digest.lower() != sha256:
+            raise cherrypy.HTTPError(400, 'SHA256 digest does not match')
+        project = self._project_dir(name)
+        if not self._store(project, filename, content.file, replace=False):
+            raise cherrypy.HTTPError(409, 'File already exists')
+        return 'OK'
+
     @cherrypy.expose
     def admin(self, project=None, newdir=None, delproj=None,
               delfiles=None, upfiles=None, passwd=None, logout=None):
@@ -93,43 +297,47 @@ class Root:
             return render(
                 'overview.html', project_base_url='?project=',
                 message=message, logged_in=True,
-                projects=sorted(os.listdir(self._storage)))
+                projects=self._index.projects())
 
     def _files(self, project):
-        proj_path = os.path.join(self._storage, project)
-        files = None
-        if os.path.exists(proj_path):
-            files = []
-            with os.scandir(proj_path) as it:
-                for entry in sorted(it, key=lambda e: parse_version(e.name)):
-                    if entry.name.endswith(hash_ext):
-                        continue
-                    stat = entry.stat()
-                    files.append(ProjectFile(
-                        entry.name,
-                        path_join(path, storage, project, entry.name),
-                        format_bin_prefix('.1f', stat.st_size),
-                        datetime.fromtimestamp(
-                            stat.st_mtime).isoformat(' ', 'seconds')))
-        return files
+        stored_files = self._index.files(project)
+        if stored_files is None:
+            return None
+        return [ProjectFile(
+                    file.name, path_join(path, storage, project, file.name),
+                    format_bin_prefix('.1f', file.size),
+                    datetime.fromtimestamp(
+                        file.mtime).isoformat(' ', 'seconds'))
+                for file in stored_files]
 
     def _delfiles(self, project, delfiles):
         if not isinstance(delfiles, list):
             delfiles = [delfiles]
+        project_path = os.path.join(self._storage, project)
         for file in delfiles:
             try:
-                path = os.path.join(self._storage, project, file)
-                os.remove(path)
-                hash_path = path + hash_ext
-                if os.path.exists(hash_path):
-                    os.remove(hash_path)
+                path = os.path.join(project_path, file)
+                with project_lock(project_path):
+                    remove_file(path)
             except OSError as ex:
                 return str(ex), True
+            finally:
+                self._index.update(project, file)
         return f'{len(delfiles)} file(s) deleted.', False
 
     def _deldir(self, deldir):
         try:
-            shutil.rmtree(os.path.join(self._storage, deldir))
+            project_path = os.path.join(self._storage, deldir)
+            with project_lock(project_path):
+                with os.scandir(project_path) as it:
+                    hashes = [_read_hash(entry.path) for entry in it
+                              if is_artifact(entry.name)]
+                shutil.rmtree(project_path)
+                for sha256 in filter(None, hashes):
+                    release_blob(self._storage, sha256)
+                shutil.rmtree(os.path.join(self._storage, pages_dir, deldir),
+                              ignore_errors=True)
+            self._index.remove_project(deldir)
             return f'Project "{deldir}" deleted.', False
         except OSError as ex:
             return str(ex), True
@@ -140,6 +348,7 @@ class Root:
         else:
             try:
                 os.mkdir(os.path.join(self._storage, newdir))
+                self._index.add_project(newdir)
                 return f'Directory "{newdir}" created.', False
             except OSError as ex:
                 return str(ex), True
@@ -147,27 +356,52 @@ class Root:
     def _upload(self, project, files):
         if not isinstance(files, list):
             files = [files]
-        if not all(file.filename.startswith(project + '-') for file in files):
-            for file in files:
-                file.file.close()
+        if not all(file.filename.startswith(project + '-') and
+                   isinstance(file.file, UploadFile) for file in files):
             return ('One or more files do not belong to this'
                     ' project. Upload cancelled!'), True
         try:
             for file in files:
-                file_path = os.path.join(self._storage, project, file.filename)
-                hash_data = hashlib.sha256()
-                with file.file, open(file_path, 'wb') as fh:
-                    while True:
-                        chunk = file.file.read(chunk_size)
-                        if not chunk:
-                            break
-                        fh.write(chunk)
-                        hash_data.update(chunk)
-                write_all(file_path + hash_ext, hash_data.hexdigest())
+                self._store(project, file.filename, file.file)
         except OSError as ex:
             return str(ex), True
         return f'{len(files)} file(s) uploaded.', False
 
+    def _store(self, project, filename, upload, replace=True):
+        project_path = os.path.join(self._storage, project)
+        file_path = os.path.join(project_path, filename)
+        sha256 = upload.sha256()
+        with project_lock(project_path):
+            old_sha256 = _read_hash(file_path)
+            if (not replace and old_sha256 != sha256 and
+                    os.path.exists(file_path)):
+                return False
+            write_all(file_path + hash_ext, sha256)
+            write_all(file_path + upload_ext, '')
+            upload.commit(file_path)
+            if self._blobs:
+                self._blobs.add(sha256, file_path)
+            if old_sha256 and old_sha256 != sha256:
+                release_blob(self._storage, old_sha256)
+        extract_metadata(file_path)
+        self._index.update(project, filename)
+        return True
+
+    def _project_dir(self, name):
+        if not proj_nam_re.match(name):
+            raise cherrypy.HTTPError(400, f'Invalid project name: {name}')
+        name = canonicalize_name(name)
+        for project in self._index.projects():
+            if canonicalize_name(project) == name:
+                return project
+        os.makedirs(os.path.join(self._storage, name), exist_ok=True)
+        self._index.add_project(name)
+        return name
+
+    def _check_token(self, realm, username, password):
+        return any(hmac.compare_digest(password.encode(), token.encode())
+                   for token in self._upload_tokens)
+
 
 _INVALID_NAME_MSG = '''Invalid project directory name: "%s"<br>
 Permitted characters:
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import plac
+
+from .blobs import BlobStore
+from .configuration import configure
+from .root import (hash_ext, is_artifact, project_lock, sidecar_exts,
+                   quarantine_dir, scrub_state)
+from .utils import write_atomic
+
+_BUFFER_SIZE = 1 << 20
+
+
+@plac.annotations(
+    config='Configuration file',
+    jobs=('Number of worker processes', 'option', 'j', int),
+    quarantine=('Move files with a wrong hash to the quarantine directory',
+                'flag', 'q'),
+    full=('Check all files, also those unchanged since the last run',
+          'flag', 'f'))
+def scrub(config, jobs=os.cpu_count(), quarantine=False, full=False):
+    """Add missing .sha256 files and verify the existing ones."""
+    cfg = configure(config, serve=False)
+    storage_path = cfg['storage-path']
+    state_path = os.path.join(storage_path, scrub_state)
+    state = {} if full else _load_state(state_path)
+    new_state = {}
+    files = []
+    for key, file_path, size, mtime in _walk(storage_path):
+        if state.get(key) == [size, mtime]:
+            new_state[key] = state[key]
+        else:
+            files.append((key, file_path, size, mtime))
+    counts = dict.fromkeys(('added', 'ok', 'mismatch', 'error'), 0)
+    with ProcessPoolExecutor(jobs) as executor:
+        results = executor.map(_check, [file_path for _, file_path, _, _
+                                        in files], chunksize=16)
+        for (key, file_path, size, mtime), (expected, actual, error) in zip(
+                files, results):
+            if error:
+                counts['error'] += 1
+                print(f'{key}: {error}', file=sys.stderr)
+            elif expected is None:
+                with project_lock(os.path.dirname(file_path)):
+                    write_atomic(file_path + hash_ext, actual)
+                counts['added'] += 1
+                new_state[key] = [size, mtime]
+            elif expected == actual:
+                counts['ok'] += 1
+                new_state[key] = [size, mtime]
+            else:
+                counts['mismatch'] += 1
+                print(f'{key}: sha256 mismatch {actual} != {expected}',
+                      file=sys.stderr)
+                if quarantine:
+                    _quarantine(storage_path, key, file_path, expected)
+    write_atomic(state_path, json.dumps(new_state))
+    print(f'{len(files)} file(s) checked,'
+          f' {len(new_state) - counts["ok"] - counts["added"]} unchanged,'
+          f' {counts["added"]} hash(es) added, {counts["mismatch"]}'
+          f' mismatch(es), {counts["error"]} error(s)')
+    if counts['mismatch'] or counts['error']:
+        sys.exit(1)
+
+
+def _walk(storage_path):
+    with os.scandir(storage_path) as projects:
+        for project in projects:
+            if project.name.startswith('.') or not project.is_dir():
+                continue
+            with os.scandir(project.path) as it:
+                for entry in it:
+                    if is_artifact(entry.name) and entry.is_file():
+                        stat = entry.stat()
+                        yield (f'{project.name}/{entry.name}', entry.path,
+                               stat.st_size, stat.st_mtime_ns)
+
+
+def _check(file_path):
+    try:
+        try:
+            with open(file_path + hash_ext) as fh:
+                expected = fh.read().strip()
+        except FileNotFoundError:
+            expected = None
+        data = hashlib.sha256()
+        buffer = bytearray(_BUFFER_SIZE)
+        view = memoryview(buffer)
+        with open(file_path, 'rb', buffering=0) as fh:
+            while True:
+                n = fh.readinto(buffer)
+                if not n:
+                    break
+                data.update(view[:n])
+        return expected, data.hexdigest(), None
+    except OSError as ex:
+        return None, None, str(ex)
+
+
+def _quarantine(storage_path, key, file_path, expected):
+    project_path = os.path.dirname(file_path)
+    target_path = os.path.join(storage_path, quarantine_dir, key)
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    blob_path = BlobStore(storage_path).path(expected)
+    with project_lock(project_path):
+        os.replace(file_path, target_path)
+        for ext in sidecar_exts:
+            if os.path.exists(file_path + ext):
+                os.remove(file_path + ext)
+        # a corrupt blob must not be linked into other projects
+        if (os.path.exists(blob_path) and
+                os.path.samefile(blob_path, target_path)):
+            os.remove(blob_path)
+    print(f'{key}: moved to {target_path}', file=sys.stderr)
+
+
+def _load_state(state_path):
+    try:
+        with open(state_path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
@@ -1,140 +1,254 @@
+import gzip
 import os
-import re
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
 from posixpath import join as path_join
-from urllib.parse import quote as urlquote, urljoin
+from urllib.parse import quote as urlquote
 
 import cherrypy
 import requests
-from packaging.version import parse as parse_version
-from salmagundi.files import read_all
+from cherrypy.lib import cptools
+from cherrypy.lib.encoding import set_vary_header
+from packaging.utils import canonicalize_name
 
-from . import root, SIMPLE_PATH
+from . import pages, root, tracing, SIMPLE_PATH
+from .cache import RenderedPages
+from .indexes import UpstreamIndex
 from .packs import path as packs_path
+from .utils import file_version, version_key
 
 path = SIMPLE_PATH
-config = {'/': {}}
-replace_re = re.compile(
-    '<a href=(?P<quote>[\'"])(?P<url>.+?)(?:#(?P<hash>.+?))?(?P=quote)')
-search_re = re.compile('>(.+?)</a>')
+config = {'/': {'tools.encode.text_only': False}}
+gzip_mime_types = ['text/html', 'text/plain', pages.JSON_TYPE,
+                   pages.HTML_TYPE]
 root_storage = path_join(root.path, root.storage)
-hash_ext = root.hash_ext
 
 
 class Simple:
-    def __init__(self, cfg):
-        self._index_url = cfg['index-url']
-        if self._index_url and not self._index_url.endswith('/'):
-            self._index_url += '/'
-        self._storage = cfg['storage-path']
-        self._proxies = cfg['proxies']
-        self._timeout = cfg['timeout']
-        self._retries = cfg['retries']
-        self._headers = {'User-Agent': cfg['user-agent']}
+    def __init__(self, cfg, client, index):
+        self._index = index
+        self._gzip_level = cfg['gzip-level']
+        if self._gzip_level:
+            config['/'].update({'tools.gzip.on': True,
+                                'tools.gzip.compress_level': self._gzip_level,
+                                'tools.gzip.mime_types': gzip_mime_types})
+        self._rendered = RenderedPages(
+            os.path.join(cfg['storage-path'], root.pages_dir))
+        self._upstreams = [UpstreamIndex(cfg, client, url)
+                           for url in cfg['index-url'] or ()]
+        self._pins = [(canonicalize_name(pattern), self._upstreams[pos])
+                      for pattern, pos in cfg['index-pins'] or ()]
+        self._local_projects = [canonicalize_name(pattern)
+                                for pattern in cfg['local-projects'] or ()]
+        if len(self._upstreams) > 1:
+            self._executor = ThreadPoolExecutor(
+                4 * len(self._upstreams), 'Upstream')
+        else:
+            self._executor = None
 
     @cherrypy.expose
     def default(self, project):
-        response = None
-        if self._index_url:
-            for i in range(self._retries + 1):
-                try:
-                    response = requests.get(f'{self._index_url}{project}/',
-                                            headers=self._headers,
-                                            proxies=self._proxies,
-                                            timeout=self._timeout)
-                    break
-                except requests.ConnectionError as ex:
-                    if i == self._retries:
-                        cherrypy.log(str(ex) + ' (quit)')
-                        break
-                    else:
-                        cherrypy.log(str(ex) + ' (retry)')
-                except Exception as ex:
-                    msg = str(ex)
-                    cherrypy.log(msg)
-                    raise cherrypy.HTTPError(message=msg)
-        project_path = os.path.join(self._storage, project)
-        if not response or response.status_code == requests.codes.NOT_FOUND:
-            return self._local(project, project_path)
-        elif response and response.status_code == requests.codes.OK:
-            return self._remote(project, project_path, response)
-        else:
-            raise cherrypy.HTTPError(response.status_code)
-
-    def _local(self, project, project_path):
-        if os.path.exists(project_path):
-            lines = []
-            for file in sorted(os.listdir(project_path), key=parse_version):
-                if file.endswith(hash_ext):
-                    continue
-                url = path_join(root_storage, project, file)
-                hash_file = os.path.join(project_path, file + hash_ext)
-                if os.path.exists(hash_file):
-                    url += '#' + read_all(hash_file).strip()
-                lines.append(f'<a href="{url}">{file}</a><br>')
-            if lines:
-                return _HTML % dict(project=project, content='\n'.join(lines))
-        raise cherrypy.HTTPError(requests.codes.NOT_FOUND)
-
-    def _remote(self, project, project_path, response):
-        def replace(m):
-            return self._replace(m, project)
-        if os.path.exists(project_path):
-            def replace_local(m):
-                return self._replace(m, project, True)
-            local_files = self._local_files(project_path)
-            lines = []
-            for line in response.text.splitlines():
-                if '<a ' in line:
-                    file = search_re.search(line)[1]
-                    if file in local_files:
-                        item = (file, replace_re.sub(replace_local, line))
-                        del local_files[file]
-                    else:
-                        item = (file, replace_re.sub(replace, line))
-                    lines.append(item)
-            for file in local_files:
-                url = path_join(root_storage, project, file)
-                hash_data = local_files[file]
-                if hash_data:
-                    url += '#' + hash_data
-                lines.append((file, f'<a href="{url}">{file}</a><br>'))
-            lines.sort(key=lambda x: parse_version(x[0]))
-            content = '\n'.join(line[1] for line in lines)
-            return _HTML % dict(project=project, content=content)
-        return replace_re.sub(replace, response.text)
-
-    def _local_files(self, project_path):
-        rv = {}
-        for file in os.listdir(project_path):
-            if file.endswith(hash_ext):
+        media_type = pages.negotiate(
+            cherrypy.request.headers.elements('Accept'))
+        if not media_type:
+            raise cherrypy.HTTPError(requests.codes.NOT_ACCEPTABLE)
+        cherrypy.response.headers['Vary'] = 'Accept'
+        upstream_pages = self._upstream_pages(
+            project, html=media_type != pages.JSON_TYPE)
+        cherrypy.response.headers['Content-Type'] = media_type
+        if not upstream_pages:
+            return self._local_page(project, media_type)
+        if media_type != pages.JSON_TYPE and not any(
+                pages.is_json(content_type)
+                for _, (_, content_type) in upstream_pages):
+            cherrypy.response.stream = True
+            return self._stream_html(project, upstream_pages)
+        files, versions = self._combine(project, upstream_pages)
+        files = self._merge(project, files)
+        with tracing.phase('render'):
+            return _render(project, media_type, files, versions)
+
+    def upstream_files(self, project):
+        upstream_pages = self._upstream_pages(project)
+        if upstream_pages:
+            return self._combine(project, upstream_pages)
+        return [], []
+
+    def _upstream_pages(self, project, html=False):
+        cache_key = canonicalize_name(project)
+        upstreams = self._select(cache_key)
+        if len(upstreams) == 1:
+            page = upstreams[0].get(project, cache_key, html)
+            return [(upstreams[0], page)] if page else []
+        elif not upstreams:
+            return []
+        futures = [(upstream, self._executor.submit(
+                    tracing.wrap(upstream.get), project, cache_key, html))
+                   for upstream in upstreams]
+        rv = []
+        error = None
+        for upstream, future in futures:
+            try:
+                page = future.result()
+            except cherrypy.HTTPError as ex:
+                cherrypy.log(f'{upstream.page_url(project)}: {ex}')
+                error = error or ex
                 continue
-            hash_file = os.path.join(project_path, file + hash_ext)
-            if os.path.exists(hash_file):
-                hash_data = read_all(hash_file).strip()
-            else:
-                hash_data = None
-            rv[file] = hash_data
+            if page:
+                rv.append((upstream, page))
+        if not rv and error:
+            raise error
         return rv
 
-    def _replace(self, m, project, local=False):
-        if local:
-            url = path_join(root_storage, project, m['url'].rsplit('/', 1)[-1])
-            if m['hash']:
-                return f'<a href="{url}#{m["hash"]}"'
-            else:
-                return f'<a href="{url}"'
+    def _local_page(self, project, media_type):
+        with tracing.phase('storage'):
+            stored_files = self._index.files(project)
+        if not stored_files:
+            raise cherrypy.HTTPError(requests.codes.NOT_FOUND)
+        kind = 'json' if media_type == pages.JSON_TYPE else 'html'
+
+        def render():
+            return _render(project, media_type,
+                           list(_file_dicts(project, stored_files).values()),
+                           [])
+        if self._gzip_level:
+            set_vary_header(cherrypy.response, 'Accept-Encoding')
+            if _accepts_gzip():
+                kind += '.gz'
+                plain = render
+
+                def render():
+                    return gzip.compress(plain().encode('utf-8'),
+                                         self._gzip_level)
+                cherrypy.response.headers['Content-Encoding'] = 'gzip'
+                # already compressed, keep the gzip tool off this response
+                cherrypy.request.cached = True
+        with tracing.phase('render'):
+            body, etag = self._rendered.get(project, kind, stored_files,
+                                            render)
+        cherrypy.response.headers['ETag'] = etag
+        cptools.validate_etags()
+        return body
+
+    def _stream_html(self, project, upstream_pages):
+        local_files = self._local_files(project)
+        seen = set()
+        yield pages.html_head(project)
+        for upstream, (chunks, _) in upstream_pages:
+            parser = pages.AnchorParser(upstream.page_url(project))
+            for chunk in chunks:
+                parser.feed(chunk)
+                yield self._rewrite(project, parser.pop_files(), local_files,
+                                    seen)
+            parser.close()
+            yield self._rewrite(project, parser.pop_files(), local_files,
+                                seen)
+        yield ''.join(pages.render_anchor(file)
+                      for file in local_files.values())
+        yield pages.HTML_TAIL
+
+    def _rewrite(self, project, files, local_files, seen):
+        lines = []
+        for file in files:
+            if file['filename'] in seen:
+                continue
+            seen.add(file['filename'])
+            self._merge_file(project, file, local_files)
+            lines.append(pages.render_anchor(file))
+        return ''.join(lines)
+
+    def _select(self, cache_key):
+        if any(fnmatchcase(cache_key, pattern)
+               for pattern in self._local_projects):
+            return []
+        for pattern, upstream in self._pins:
+            if fnmatchcase(cache_key, pattern):
+                return [upstream]
+        return self._upstreams
+
+    def _combine(self, project, upstream_pages):
+        with tracing.phase('parse'):
+            return self._parse(project, upstream_pages)
+
+    def _parse(self, project, upstream_pages):
+        if len(upstream_pages) == 1:
+            upstream, page = upstream_pages[0]
+            return pages.parse(*page, upstream.page_url(project))
+        files = {}
+        versions = set()
+        for upstream, page in upstream_pages:
+            page_files, page_versions = pages.parse(
+                *page, upstream.page_url(project))
+            for file in page_files:
+                files.setdefault(file['filename'], file)
+            versions.update(page_versions)
+        return (sorted(files.values(),
+                       key=lambda file: version_key(file['filename'])),
+                list(versions))
+
+    def _merge(self, project, files):
+        local_files = self._local_files(project)
+        for file in files:
+            self._merge_file(project, file, local_files)
+        if local_files:
+            files.extend(local_files.values())
+            files.sort(key=lambda file: version_key(file['filename']))
+        return files
+
+    def _merge_file(self, project, file, local_files):
+        local_file = local_files.pop(file['filename'], None)
+        if local_file:
+            file['url'] = local_file['url']
+            file.pop('core-metadata', None)
+            if 'core-metadata' in local_file:
+                file['core-metadata'] = local_file['core-metadata']
         else:
-            url = urljoin(self._index_url, m['url'])
-            if m['hash']:
-                return (f'<a href="{packs_path}/{project}/'
-                        f'{urlquote(url)}#{m["hash"]}"')
-            else:
-                return f'<a href="{packs_path}/{project}/{urlquote(url)}"'
-
-
-_HTML = '''<!DOCTYPE html>
-<html><head><title>Links for %(project)s</title></head><body>
-<h1>Links for %(project)s</h1>
-%(content)s
-</body></html>
-'''
+            file['url'] = self._packs_url(project, file)
+
+    def _local_files(self, project):
+        with tracing.phase('storage'):
+            return _file_dicts(project, self._index.files(project) or ())
+
+    def _packs_url(self, project, file):
+        url = f'{packs_path}/{project}/'
+        hashes = file.get('hashes')
+        if hashes:
+            name = 'sha256' if 'sha256' in hashes else next(iter(hashes))
+            url += urlquote(f'{name}={hashes[name]}') + '/'
+        return url + urlquote(file['url'])
+
+
+def _accepts_gzip():
+    for coding in cherrypy.request.headers.elements('Accept-Encoding'):
+        if coding.value in ('gzip', 'x-gzip'):
+            return coding.qvalue > 0
+    return False
+
+
+def _file_dicts(project, stored_files):
+    rv = {}
+    for stored_file in stored_files:
+        rv[stored_file.name] = file = {
+            'filename': stored_file.name,
+            'url': path_join(root_storage, project, stored_file.name),
+            'hashes': stored_file.hashes,
+            'size': stored_file.size}
+        if stored_file.metadata is not None:
+            file['core-metadata'] = stored_file.metadata or True
+    return rv
+
+
+def _render(project, media_type, files, versions):
+    if media_type == pages.JSON_TYPE:
+        return pages.render_json(canonicalize_name(project), files,
+                                 _versions(files, versions))
+    return pages.render_html(project, files)
+
+
+def _versions(files, versions):
+    rv = set(versions)
+    for file in files:
+        version = file_version(file['filename'])
+        if version:
+            rv.add(str(version))
+    return sorted(rv)
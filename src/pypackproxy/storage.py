@@ -0,0 +1,193 @@
+import os
+import threading
+import time
+from collections import namedtuple
+
+import cherrypy
+from salmagundi.files import read_all
+
+from .root import hash_ext, is_artifact, metadata_ext, upload_ext
+from .utils import version_key
+
+StoredFile = namedtuple('StoredFile',
+                        'name size mtime atime hashes metadata uploaded')
+_ATIME_RESOLUTION = 3600
+
+
+class StorageIndex:
+    def __init__(self, cfg):
+        self._path = cfg['storage-path']
+        self._validate = cfg['workers'] > 1
+        self._root_mtime = None
+        self._lock = threading.Lock()
+        self._projects = {}
+        self._mtimes = {}
+        self._sorted = {}
+        self._size = 0
+        self._count = 0
+
+    def load(self):
+        self.rescan()
+        cherrypy.log(f'storage index: {len(self._projects)} project(s)',
+                     'INFO')
+
+    def projects(self):
+        self._revalidate()
+        with self._lock:
+            return sorted(self._projects)
+
+    def files(self, project):
+        self._revalidate(project)
+        with self._lock:
+            files = self._sorted.get(project)
+            if files is None:
+                if project not in self._projects:
+                    return None
+                files = self._sorted[project] = tuple(sorted(
+                    self._projects[project].values(),
+                    key=lambda f: version_key(f.name)))
+            return files
+
+    def get(self, project, name):
+        self._revalidate(project)
+        with self._lock:
+            return self._projects.get(project, {}).get(name)
+
+    def size(self):
+        return self._size
+
+    def count(self):
+        return self._count
+
+    def entries(self):
+        with self._lock:
+            return [(project, file)
+                    for project, files in self._projects.items()
+                    for file in files.values()]
+
+    def touch(self, project, name):
+        now = time.time()
+        with self._lock:
+            files = self._projects.get(project, {})
+            file = files.get(name)
+            if file is None or now - file.atime < _ATIME_RESOLUTION:
+                return
+            files[name] = file._replace(atime=now)
+        try:
+            os.utime(os.path.join(self._path, project, name),
+                     (now, file.mtime))
+        except OSError as ex:
+            cherrypy.log(f'storage index: {ex}', 'WARNING')
+
+    def add_project(self, project):
+        with self._lock:
+            self._projects.setdefault(project, {})
+            self._sorted.pop(project, None)
+
+    def remove_project(self, project):
+        with self._lock:
+            self._account(self._projects.pop(project, {}).values(), -1)
+            self._mtimes.pop(project, None)
+            self._sorted.pop(project, None)
+
+    def update(self, project, name):
+        for ext in (hash_ext, metadata_ext, upload_ext):
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+        file = _stored_file(os.path.join(self._path, project, name))
+        with self._lock:
+            files = self._projects.setdefault(project, {})
+            old = files.pop(name, None)
+            if old:
+                self._account((old,), -1)
+            if file:
+                files[name] = file
+                self._account((file,), 1)
+            self._sorted.pop(project, None)
+
+    def rescan(self):
+        try:
+            self._root_mtime = os.stat(self._path).st_mtime
+            with os.scandir(self._path) as it:
+                dirs = {entry.name: entry.stat().st_mtime for entry in it
+                        if entry.is_dir() and not entry.name.startswith('.')}
+        except OSError as ex:
+            cherrypy.log(f'storage index: {ex}', 'WARNING')
+            return
+        with self._lock:
+            removed = set(self._projects) - set(dirs)
+            changed = [project for project, mtime in dirs.items()
+                       if self._mtimes.get(project) != mtime]
+        for project in removed:
+            self.remove_project(project)
+        for project in changed:
+            self._rescan_project(project, dirs[project])
+
+    def _rescan_project(self, project, mtime):
+        files = _scan_project(os.path.join(self._path, project))
+        with self._lock:
+            self._account(self._projects.get(project, {}).values(), -1)
+            self._account(files.values(), 1)
+            self._projects[project] = files
+            self._mtimes[project] = mtime
+            self._sorted.pop(project, None)
+
+    def _account(self, files, sign):
+        for file in files:
+            self._size += sign * file.size
+            self._count += sign
+
+    def _revalidate(self, project=None):
+        if not self._validate:
+            return
+        if project is None:
+            try:
+                if os.stat(self._path).st_mtime != self._root_mtime:
+                    self.rescan()
+            except OSError:
+                pass
+            return
+        if project.startswith('.'):
+            return
+        try:
+            mtime = os.stat(os.path.join(self._path, project)).st_mtime
+        except OSError:
+            if project in self._projects:
+                self.remove_project(project)
+            return
+        if self._mtimes.get(project) != mtime:
+            self._rescan_project(project, mtime)
+
+
+def _scan_project(project_path):
+    files = {}
+    try:
+        with os.scandir(project_path) as it:
+            for entry in it:
+                if is_artifact(entry.name):
+                    file = _stored_file(entry.path)
+                    if file:
+                        files[entry.name] = file
+    except OSError as ex:
+        cherrypy.log(f'storage index: {ex}', 'WARNING')
+    return files
+
+
+def _stored_file(file_path):
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    metadata_path = file_path + metadata_ext
+    metadata = (_read_hashes(metadata_path)
+                if os.path.exists(metadata_path) else None)
+    return StoredFile(os.path.basename(file_path), stat.st_size,
+                      stat.st_mtime, stat.st_atime, _read_hashes(file_path),
+                      metadata, os.path.exists(file_path + upload_ext))
+
+
+def _read_hashes(file_path):
+    try:
+        return {'sha256': read_all(file_path + hash_ext).strip()}
+    except FileNotFoundError:
+        return {}
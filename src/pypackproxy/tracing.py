@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import cherrypy
+
+PHASES = ('upstream', 'storage', 'parse', 'render')
+trace_log = logging.getLogger('pypackproxy.trace')
+trace_log.propagate = False
+_traceparent_re = re.compile(
+    r'^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+_local = threading.local()
+
+
+class Trace:
+    def __init__(self, traceparent=None):
+        self.parent_id = None
+        self.sampled = False
+        match = _traceparent_re.match(traceparent or '')
+        if match and match.group(1).strip('0') and match.group(2).strip('0'):
+            self.trace_id, self.parent_id, flags = match.groups()
+            self.sampled = bool(int(flags, 16) & 1)
+        else:
+            self.trace_id = os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.start = time.time()
+        self.start_counter = time.perf_counter()
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def durations(self):
+        with self._lock:
+            return dict(self.phases)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start_counter
+
+    def traceparent(self):
+        flags = '01' if self.sampled else '00'
+        return f'00-{self.trace_id}-{os.urandom(8).hex()}-{flags}'
+
+    def server_timing(self):
+        durations = self.durations()
+        phases = [(phase, durations[phase]) for phase in PHASES
+                  if phase in durations]
+        phases.append(('total', self.elapsed()))
+        return ', '.join(f'{phase};dur={seconds * 1000:.1f}'
+                         for phase, seconds in phases)
+
+    def span(self, name, attributes):
+        """Return the trace as an OpenTelemetry (OTLP/JSON) style span."""
+        end = self.start + self.elapsed()
+        attributes = dict(attributes, **{
+            f'pypackproxy.{phase}_ms': round(seconds * 1000, 3)
+            for phase, seconds in self.durations().items()})
+        return {'traceId': self.trace_id,
+                'spanId': self.span_id,
+                'parentSpanId': self.parent_id or '',
+                'name': name,
+                'kind': 'SPAN_KIND_SERVER',
+                'startTimeUnixNano': int(self.start * 1e9),
+                'endTimeUnixNano': int(end * 1e9),
+                'attributes': attributes}
+
+
+def current():
+    trace = getattr(cherrypy.serving.request, 'trace', None)
+    return trace or getattr(_local, 'trace', None)
+
+
+@contextmanager
+def phase(name):
+    trace = current()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - start)
+
+
+def wrap(func):
+    """Run func in another thread as part of the current trace."""
+    trace = current()
+    if trace is None:
+        return func
+
+    def wrapper(*args, **kwargs):
+        _local.trace = trace
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.trace = None
+    return wrapper
+
+
+class _TracingTool(cherrypy.Tool):
+    def __init__(self):
+        super().__init__('on_start_resource', self._start)
+
+    def _setup(self):
+        super()._setup()
+        conf = self._merged_args()
+        hooks = cherrypy.serving.request.hooks
+        if conf.get('server_timing', True):
+            hooks.attach('before_finalize', self._server_timing)
+        hooks.attach('on_end_request', self._end,
+                     slow=conf.get('slow', 0), sample=conf.get('sample', 0))
+
+    @staticmethod
+    def _start(**kwargs):
+        request = cherrypy.serving.request
+        request.trace = Trace(request.headers.get('traceparent'))
+
+    @staticmethod
+    def _server_timing():
+        trace = getattr(cherrypy.serving.request, 'trace', None)
+        if trace:
+            cherrypy.serving.response.headers['Server-Timing'] = (
+                trace.server_timing())
+
+    @staticmethod
+    def _end(slow, sample):
+        request = cherrypy.serving.request
+        trace = getattr(request, 'trace', None)
+        if trace is None:
+            return
+        elapsed = trace.elapsed()
+        target = request.script_name + request.path_info
+        if slow and elapsed >= slow:
+            phases = ' '.join(f'{phase}={seconds * 1000:.1f}ms'
+                              for phase, seconds
+                              in trace.durations().items())
+            cherrypy.log(f'slow request {request.method} {target}'
+                         f' {elapsed * 1000:.1f}ms trace={trace.trace_id}'
+                         f' {phases}'.rstrip(), 'WARNING')
+        elif not (trace.sampled or sample and random.random() < sample):
+            return
+        if trace_log.handlers:
+            status = int(str(cherrypy.serving.response.status)[:3])
+            span = trace.span(f'{request.method} {target}',
+                              {'http.method': request.method,
+                               'http.target': target,
+                               'http.status_code': status})
+            trace_log.info(json.dumps(span))
+
+
+cherrypy.tools.tracing = _TracingTool()
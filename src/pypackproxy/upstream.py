@@ -0,0 +1,106 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+import cherrypy
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics, tracing
+
+
+class Upstream:
+    def __init__(self, cfg):
+        self._timeout = cfg['timeout']
+        self._retries = cfg['retries']
+        self._proxies = cfg['proxies']
+        self._breaker = CircuitBreaker(cfg['breaker-threshold'],
+                                       cfg['breaker-cooldown'])
+        self._session = requests.Session()
+        self._session.headers['User-Agent'] = cfg['user-agent']
+        for prefix in ('http://', 'https://'):
+            self._session.mount(prefix, HTTPAdapter(
+                pool_connections=cfg['pool-connections'],
+                pool_maxsize=cfg['pool-maxsize']))
+
+    def get(self, url, headers=None, stream=False):
+        host = urlparse(url).netloc
+        try:
+            self._breaker.check(host)
+        except CircuitOpenError:
+            metrics.upstream_errors.inc(host, 'circuit')
+            raise
+        trace = tracing.current()
+        if trace:
+            headers = dict(headers or (), traceparent=trace.traceparent())
+        for i in range(self._retries + 1):
+            start = time.perf_counter()
+            try:
+                with tracing.phase('upstream'):
+                    response = self._session.get(url, headers=headers,
+                                                 stream=stream,
+                                                 proxies=self._proxies,
+                                                 timeout=self._timeout)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                metrics.upstream_errors.inc(
+                    host, 'timeout' if isinstance(ex, requests.Timeout)
+                    else 'connection')
+                if i == self._retries:
+                    cherrypy.log(str(ex) + ' (quit)')
+                    self._breaker.failure(host)
+                    raise
+                cherrypy.log(str(ex) + ' (retry)')
+            else:
+                metrics.upstream_duration.observe(
+                    time.perf_counter() - start, host)
+                if response.status_code >= 500:
+                    metrics.upstream_errors.inc(host, 'status')
+                    self._breaker.failure(host)
+                else:
+                    self._breaker.success(host)
+                return response
+
+    def close(self):
+        self._session.close()
+
+
+class CircuitOpenError(requests.ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._opened = {}
+
+    def check(self, host):
+        if not self._threshold:
+            return
+        with self._lock:
+            opened = self._opened.get(host)
+            if opened is None:
+                return
+            if time.monotonic() - opened < self._cooldown:
+                raise CircuitOpenError(f'circuit open for {host}')
+            # half-open: let this request through, block the others
+            self._opened[host] = time.monotonic()
+
+    def success(self, host):
+        with self._lock:
+            self._failures.pop(host, None)
+            if self._opened.pop(host, None) is not None:
+                cherrypy.log(f'circuit closed for {host}')
+
+    def failure(self, host):
+        if not self._threshold:
+            return
+        with self._lock:
+            failures = self._failures.get(host, 0) + 1
+            self._failures[host] = failures
+            if failures >= self._threshold:
+                if host not in self._opened:
+                    cherrypy.log(f'circuit opened for {host}', 'WARNING')
+                self._opened[host] = time.monotonic()
@@ -1,9 +1,15 @@
 import atexit
+import fcntl
 import os
-from contextlib import ExitStack
+import tempfile
+from contextlib import contextmanager, ExitStack
 from importlib.resources import path as res_path
 from urllib.parse import urlparse
 
+from packaging.utils import (parse_sdist_filename, parse_wheel_filename,
+                             InvalidSdistFilename, InvalidWheelFilename)
+from packaging.version import InvalidVersion
+
 from . import DATA_PACKAGE
 
 
@@ -45,12 +51,12 @@ def check_passwd(s):
     return s
 
 
+_SIZE_UNITS = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
 def file_size(s):
-    if len(s) >= 2 and s[-1].upper() in ('K', 'M'):
-        num = float(s[:-1])
-        if s[-1].upper() == 'K':
-            return round(num * 2 ** 10)
-        return round(num * 2 ** 20)
+    if len(s) >= 2 and s[-1].upper() in _SIZE_UNITS:
+        return round(float(s[:-1]) * _SIZE_UNITS[s[-1].upper()])
     else:
         return int(s)
 
@@ -62,8 +68,57 @@ def pos_float(s):
     return x
 
 
+def str_list(s):
+    return s.replace(',', ' ').split()
+
+
 def pos_int(s):
     x = int(s)
     if x < 0:
         raise ValueError('value must be >= 0')
     return x
+
+
+def temp_file(dir_path, suffix='.tmp'):
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.', suffix=suffix)
+    os.fchmod(fd, 0o644)
+    return os.fdopen(fd, 'wb'), tmp_path
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def write_atomic(path, data):
+    fh, tmp_path = temp_file(os.path.dirname(path))
+    try:
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        with fh:
+            fh.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def file_version(filename):
+    try:
+        if filename.endswith('.whl'):
+            return parse_wheel_filename(filename)[1]
+        return parse_sdist_filename(filename)[1]
+    except (InvalidSdistFilename, InvalidWheelFilename, InvalidVersion):
+        return None
+
+
+def version_key(filename):
+    version = file_version(filename)
+    if version is None:
+        return 0, filename
+    return 1, version, filename
@@ -0,0 +1,158 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import plac
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.utils import canonicalize_name
+from salmagundi.strings import format_bin_prefix
+
+from . import packs, simple, storage, upstream
+from .configuration import configure
+from .utils import file_version
+
+
+@plac.annotations(
+    config='Configuration file',
+    jobs=('Number of parallel downloads', 'option', 'j', int),
+    all_versions=('Fetch all matching versions, not only the newest',
+                  'flag', 'a'),
+    sources='Requirement/lock files or requirement specifiers')
+def warm(config, jobs=8, all_versions=False, *sources):
+    """Download package files into the storage ahead of time."""
+    cfg = configure(config, serve=False)
+    cfg['pool-maxsize'] = max(cfg['pool-maxsize'], jobs)
+    client = upstream.Upstream(cfg)
+    index = storage.StorageIndex(cfg)
+    index.load()
+    resolver = simple.Simple(cfg, client, index)
+    requirements = {}
+    for source in sources:
+        if os.path.isfile(source):
+            reqs = _read_requirements(source, set())
+        else:
+            reqs = [(source, set())]
+        for line, hashes in reqs:
+            try:
+                req = Requirement(line)
+            except InvalidRequirement as ex:
+                print(f'skipped {line!r}: {ex}', file=sys.stderr)
+                continue
+            requirements.setdefault(canonicalize_name(req.name),
+                                    []).append((req, hashes))
+    start = time.monotonic()
+    with ThreadPoolExecutor(jobs) as executor:
+        futures = [executor.submit(_select, resolver, project, reqs,
+                                   all_versions)
+                   for project, reqs in requirements.items()]
+        files = {}
+        unresolved = 0
+        for future in as_completed(futures):
+            try:
+                selected, missing = future.result()
+            except Exception as ex:
+                unresolved += 1
+                print(f'error: {ex}', file=sys.stderr)
+                continue
+            unresolved += missing
+            for project, file in selected:
+                files[project, file['filename']] = file
+        total = len(files)
+        print(f'{len(requirements)} project(s), {total} file(s)')
+        futures = {executor.submit(packs.fetch, cfg, client, index, project,
+                                   file['url'], _digest(file)): file
+                   for (project, _), file in files.items()}
+        done = fetched = errors = 0
+        for future in as_completed(futures):
+            done += 1
+            name = futures[future]['filename']
+            try:
+                size = future.result()
+            except Exception as ex:
+                errors += 1
+                print(f'[{done}/{total}] {name}: {ex}', file=sys.stderr)
+                continue
+            if size is None:
+                print(f'[{done}/{total}] {name} (cached)')
+                continue
+            fetched += size
+            print(f'[{done}/{total}] {name} {format_bin_prefix(".1f", size)}'
+                  f' ({_rate(fetched, start)})')
+    client.close()
+    print(f'{format_bin_prefix(".1f", fetched)} in'
+          f' {time.monotonic() - start:.1f}s ({_rate(fetched, start)}),'
+          f' {errors} error(s), {unresolved} unresolved requirement(s)')
+    if errors or unresolved:
+        sys.exit(1)
+
+
+def _select(resolver, project, reqs, all_versions):
+    files, _ = resolver.upstream_files(project)
+    versions = {}
+    for file in files:
+        version = file_version(file['filename'])
+        if version is not None:
+            versions.setdefault(version, []).append(file)
+    selected = []
+    missing = 0
+    for req, hashes in reqs:
+        pinned = any(spec.operator in ('==', '===') for spec in req.specifier)
+        candidates = [version for version, vfiles in versions.items()
+                      if pinned or not all(f.get('yanked') for f in vfiles)]
+        matching = sorted(req.specifier.filter(candidates, pinned or None),
+                          reverse=True)
+        if not all_versions:
+            matching = matching[:1]
+        count = len(selected)
+        for version in matching:
+            for file in versions[version]:
+                if file.get('yanked') and not pinned:
+                    continue
+                if hashes and file['hashes'].get('sha256') not in hashes:
+                    continue
+                selected.append((project, file))
+        if len(selected) == count:
+            missing += 1
+            print(f'no files found for {req}', file=sys.stderr)
+    return selected, missing
+
+
+def _rate(size, start):
+    elapsed = max(time.monotonic() - start, 0.001)
+    return format_bin_prefix('.1f', size / elapsed) + '/s'
+
+
+def _digest(file):
+    hashes = file.get('hashes')
+    if hashes:
+        name = 'sha256' if 'sha256' in hashes else next(iter(hashes))
+        return f'{name}={hashes[name]}'
+    return None
+
+
+def _read_requirements(path, seen):
+    path = os.path.abspath(path)
+    if path in seen:
+        return []
+    seen.add(path)
+    with open(path) as fh:
+        text = fh.read().replace('\\\n', ' ')
+    rv = []
+    for line in text.splitlines():
+        line = line.split(' #', 1)[0].strip()
+        if not line or line.startswith('#'):
+            continue
+        tokens = line.split()
+        if tokens[0] in ('-r', '--requirement', '-c', '--constraint'):
+            include = os.path.join(os.path.dirname(path), tokens[1])
+            rv.extend(_read_requirements(include, seen))
+            continue
+        if line.startswith('-'):
+            continue
+        hashes = {token.split(':', 1)[1] for token in tokens
+                  if token.startswith('--hash=sha256:')}
+        requirement = ' '.join(token for token in tokens
+                               if not token.startswith('--'))
+        rv.append((requirement, hashes))
+    return rv
@@ -0,0 +1,164 @@
+import os
+import signal
+import socket
+import time
+
+import cherrypy
+from cherrypy._cpnative_server import CPHTTPServer
+from cherrypy.process.plugins import Monitor, SimplePlugin
+from cherrypy.process.wspbus import states
+
+_RESTART_DELAY = 1.0
+_worker = 0
+_monitors = []
+
+
+class WorkerServer(CPHTTPServer):
+    listen_socket = None
+
+    def prepare(self):
+        # LISTEN_PID only serves to skip CherryPy's port-free check,
+        # which fails once another worker listens on the same port
+        os.environ.pop('LISTEN_PID', None)
+        super().prepare()
+
+    def bind(self, family, type, proto=0):
+        if self.listen_socket is None:
+            return super().bind(family, type, proto)
+        sock = self.socket = self.listen_socket
+        self.bind_addr = self.resolve_real_bind_addr(sock)
+        return sock
+
+
+class WorkerMonitor(Monitor):
+    """Monitor that only runs in the first worker process."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        _monitors.append(self)
+
+    def start(self):
+        if _worker == 0:
+            super().start()
+    start.priority = Monitor.start.priority
+
+
+class Workers(SimplePlugin):
+    """Fork the worker processes and restart them when they die.
+
+    The parent process only supervises the workers, it does not serve
+    requests itself.
+    """
+
+    def __init__(self, bus, count, pidfile=None):
+        super().__init__(bus)
+        self._count = count
+        self._pidfile = pidfile
+        self._sockets = []
+        self._children = {}
+        self._started = {}
+        self._pending = {}
+
+    def subscribe(self):
+        super().subscribe()
+        cherrypy.server.unsubscribe()
+
+    def start(self):
+        global _worker
+        _worker = None
+        # every worker gets its own SO_REUSEPORT socket, the kernel
+        # spreads the connections over them
+        self._sockets = [_bind(cherrypy.server.bind_addr)
+                         for _ in range(self._count)]
+        os.environ['LISTEN_PID'] = str(os.getpid())
+        for number in range(self._count):
+            if self._spawn(number):
+                return
+    # after Daemonizer (65), before PIDFile (70) and the monitors (70)
+    start.priority = 66
+
+    def main(self):
+        if _worker is not None or self.bus.state != states.STARTED:
+            return
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            number = self._children.pop(pid, None)
+            if number is None:
+                continue
+            self.bus.log(f'Worker {pid} exited with status {status}',
+                         level=30)
+            delay = (_RESTART_DELAY if time.monotonic() -
+                     self._started[number] < _RESTART_DELAY else 0)
+            self._pending[number] = time.monotonic() + delay
+        for number, due in list(self._pending.items()):
+            if due <= time.monotonic():
+                del self._pending[number]
+                if self._spawn(number, restart=True):
+                    return
+
+    def stop(self):
+        if _worker is not None:
+            # a worker stops its own server, CherryPy's server plugin
+            # would wait in vain for the port to become free
+            if cherrypy.server.running:
+                cherrypy.server.httpserver.stop()
+                cherrypy.server.running = False
+            return
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in self._children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self._children = {}
+        self._pending = {}
+        for sock in self._sockets:
+            sock.close()
+        self._sockets = []
+
+    def _spawn(self, number, restart=False):
+        global _worker
+        pid = os.fork()
+        if pid:
+            self._children[pid] = number
+            self._started[number] = time.monotonic()
+            return False
+        _worker = number
+        WorkerServer.listen_socket = self._sockets[number]
+        for sock in self._sockets:
+            if sock is not WorkerServer.listen_socket:
+                sock.close()
+        self._sockets = []
+        self._children = {}
+        self._pending = {}
+        if self._pidfile:
+            self._pidfile.finalized = True
+            self.bus.unsubscribe('exit', self._pidfile.exit)
+        self.bus.log(f'Worker {os.getpid()} started')
+        cherrypy.server.start()
+        if restart:
+            for monitor in _monitors:
+                monitor.start()
+        return True
+
+
+def _bind(bind_addr):
+    host, port = bind_addr
+    af, socktype, proto, _, addr = socket.getaddrinfo(
+        host or None, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0,
+        socket.AI_PASSIVE)[0]
+    sock = socket.socket(af, socktype, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.bind(addr)
+    return sock